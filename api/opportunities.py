@@ -0,0 +1,150 @@
+import os
+from dataclasses import dataclass
+from enum import Enum
+
+__ttl = float(os.getenv("PICK_SHIFT_OPPORTUNITY_TTL", "600"))
+__retry_after = float(os.getenv("PICK_SHIFT_RETRY_AFTER", "3"))
+
+
+class OpportunityState(Enum):
+    NEW = "NEW"
+    PICKED = "PICKED"
+    REJECTED = "REJECTED"
+    RETRY = "RETRY"
+
+
+@dataclass
+class PickOutcome:
+    """
+    The result of a pick attempt for one shift.
+    """
+    state: OpportunityState
+    reason: str | None = None
+
+
+@dataclass
+class OpportunityEntry:
+    state: OpportunityState
+    expires_at: float
+    reason: str | None = None
+    retry_at: float | None = None
+    # Start and end of the shift in epoch seconds, known once a pick was attempted
+    time_block: tuple[float, float] | None = None
+
+
+class OpportunityCache:
+    """
+    State of the opportunities a session has seen, keyed by opportunity ID, so each pick cycle only acts
+    on what changed since the last one.
+
+    Picked and rejected opportunities are skipped until their entry expires. Opportunities whose pick failed
+    for a transient reason are retried once their retry-after time has passed.
+    """
+
+    def __init__(self, ttl: float, retry_after: float):
+        self.__ttl = ttl
+        self.__retry_after = retry_after
+        self.__entries: dict[str, OpportunityEntry] = {}
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, opportunity_id: str, now: float) -> OpportunityEntry | None:
+        """
+        Get the entry of an opportunity.
+        :param opportunity_id: The opportunity ID.
+        :param now: The current time in epoch seconds.
+        :return: The entry, or None if the opportunity is unknown or its entry expired.
+        """
+        entry = self.__entries.get(opportunity_id)
+        if entry is None or entry.expires_at <= now:
+            return None
+        return entry
+
+    def should_pick(self, opportunity_id: str, now: float) -> bool:
+        """
+        Check if a pick should be attempted for an opportunity.
+        :param opportunity_id: The opportunity ID.
+        :param now: The current time in epoch seconds.
+        :return: True if the opportunity is new, or due for a retry, False otherwise.
+        """
+        entry = self.get(opportunity_id, now)
+        if entry is None or entry.state == OpportunityState.NEW:
+            return True
+        if entry.state == OpportunityState.RETRY:
+            return entry.retry_at <= now
+        return False
+
+    def has_pending_retries(self, now: float) -> bool:
+        """
+        Check if any opportunity is due for a retry.
+        :param now: The current time in epoch seconds.
+        """
+        return any(entry.state == OpportunityState.RETRY and entry.retry_at <= now < entry.expires_at
+                   for entry in self.__entries.values())
+
+    def drop_unlisted_retries(self, listed_ids: set[str]) -> None:
+        """
+        Drop the retries of opportunities a full listing no longer contains, e.g. because someone else took them.
+        :param listed_ids: The IDs of every listed opportunity.
+        """
+        self.__entries = {key: entry for key, entry in self.__entries.items()
+                          if entry.state != OpportunityState.RETRY or key in listed_ids}
+
+    def mark_new(self, opportunity_id: str, time_block: tuple[float, float], now: float) -> None:
+        """
+        Record that a pick is being attempted for an opportunity.
+        :param opportunity_id: The opportunity ID.
+        :param time_block: The start and end of the shift in epoch seconds.
+        :param now: The current time in epoch seconds.
+        """
+        self.__entries[opportunity_id] = OpportunityEntry(OpportunityState.NEW, now + self.__ttl,
+                                                          time_block=time_block)
+
+    def get_committed_blocks(self, now: float, in_flight: bool = True) -> list[tuple[float, float]]:
+        """
+        Get the time blocks of the shifts that were picked, and optionally of those being picked.
+        :param now: The current time in epoch seconds.
+        :param in_flight: Include the shifts whose pick has not returned yet.
+        :return: The time blocks in epoch seconds.
+        """
+        states = (OpportunityState.PICKED, OpportunityState.NEW) if in_flight else (OpportunityState.PICKED,)
+        return [entry.time_block for entry in self.__entries.values()
+                if entry.state in states and entry.time_block is not None and entry.expires_at > now]
+
+    def mark_rejected(self, opportunity_id: str, reason: str, now: float) -> None:
+        """
+        Record that an opportunity must not be picked until its entry expires.
+        """
+        self.__entries[opportunity_id] = OpportunityEntry(OpportunityState.REJECTED, now + self.__ttl, reason)
+
+    def record(self, opportunity_id: str, outcome: PickOutcome, now: float) -> None:
+        """
+        Record the outcome of a pick attempt.
+        :param opportunity_id: The opportunity ID.
+        :param outcome: The outcome of the attempt.
+        :param now: The current time in epoch seconds.
+        """
+        retry_at = now + self.__retry_after if outcome.state == OpportunityState.RETRY else None
+        previous = self.__entries.get(opportunity_id)
+        time_block = None if previous is None else previous.time_block
+        expires_at = now + self.__ttl
+        # A picked shift blocks overlapping picks until it ends
+        if outcome.state == OpportunityState.PICKED and time_block is not None:
+            expires_at = max(expires_at, time_block[1])
+        self.__entries[opportunity_id] = OpportunityEntry(outcome.state, expires_at, outcome.reason, retry_at,
+                                                          time_block)
+
+    def prune(self, now: float) -> None:
+        """
+        Drop the expired entries.
+        :param now: The current time in epoch seconds.
+        """
+        self.__entries = {key: entry for key, entry in self.__entries.items() if entry.expires_at > now}
+
+
+def create_opportunity_cache() -> OpportunityCache:
+    """
+    Create an opportunity cache with the configured TTL and retry-after time.
+    """
+    return OpportunityCache(__ttl, __retry_after)
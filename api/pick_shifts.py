@@ -1,14 +1,92 @@
 import logging
 import os
 import time
-from asyncio import TaskGroup, create_task
+from asyncio import TaskGroup, create_task, Queue
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from typing import Callable, Awaitable
 
+import httpx
+
+from api.selection import ShiftValue, compile_shift_value, create_candidate, select_non_overlapping
+from api.shift_filter import ShiftFilter, compile_shift_filter
+from api.opportunities import OpportunityCache, OpportunityState, PickOutcome
+from app.models import UserConfig
 from app.session import UserSession
+from utils.clock import get_server_clock
+from utils.dispatcher import get_dispatcher
 from utils.nanoid import nanoid
-from utils.time import split_time_block, time_block_in_blocks
+from utils.session import GRAPHQL_HOST, EndpointClass, get_timeout
+from utils.time import IntervalIndex, plan_windows
 
 __pick_shift_window = int(os.getenv("PICK_SHIFT_WINDOW", "120"))
+__poll_interval = float(os.getenv("PICK_SHIFT_POLL_INTERVAL", "3"))
+__graphql_url = f"{GRAPHQL_HOST}/graphql"
+# Discovery query windows, see `plan_windows`
+__query_max_window = float(os.getenv("PICK_SHIFT_QUERY_MAX_WINDOW_DAYS", "7")) * 86400
+__query_min_window = float(os.getenv("PICK_SHIFT_QUERY_MIN_WINDOW_HOURS", "24")) * 3600
+__query_parallelism = int(os.getenv("PICK_SHIFT_QUERY_PARALLELISM", "4"))
+__query_merge_gap = float(os.getenv("PICK_SHIFT_QUERY_MERGE_GAP_HOURS", "12")) * 3600
+__batch_discovery = os.getenv("PICK_SHIFT_BATCH_DISCOVERY", "true").lower() == "true"
+__count_probe = os.getenv("PICK_SHIFT_COUNT_PROBE", "true").lower() == "true"
+# A probe cannot tell an opportunity swapped for another at the same count, fetch everything this often
+__full_fetch_interval = float(os.getenv("PICK_SHIFT_FULL_FETCH_INTERVAL", "30"))
+__batch_picks = os.getenv("PICK_SHIFT_BATCH_PICKS", "true").lower() == "true"
+__pick_batch_size = int(os.getenv("PICK_SHIFT_PICK_BATCH_SIZE", "10"))
+# HTTP statuses that reject a batched request as such, any other failure is worth another try
+__batch_rejected_status_codes = (400, 413, 422)
+# Discovery responses waiting to be filtered and dispatched
+__pipeline_size = int(os.getenv("PICK_SHIFT_PIPELINE_SIZE", "16"))
+
+
+@dataclass
+class PickPlan:
+    """
+    Everything the pick process needs that only depends on the user config, built ahead of the pick window.
+    """
+    config: UserConfig
+    url: str
+    rules: IntervalIndex
+    shift_filter: ShiftFilter
+    shift_value: ShiftValue
+    find_shifts_requests: list[dict]
+    # All windows in one aliased request, None if there is a single window or batching is disabled
+    find_shifts_batch_request: dict | None = None
+    batch_discovery: bool = True
+    batch_picks: bool = True
+    # Counts-only query of every window, None if counts probing is disabled
+    count_probe_request: dict | None = None
+    probe_counts: bool = True
+    # Opportunity count of each window when its full list was last fetched, by window index
+    window_counts: dict[int, int] = field(default_factory=dict)
+    # Time every window was last fetched in full, in epoch seconds
+    last_full_fetch: float = 0.0
+
+    def is_valid_for(self, session: UserSession) -> bool:
+        """
+        Check if the plan was built for the current config of the session.
+        """
+        return self.config is session.get_config()
+
+
+def __get_pick_window(session: UserSession) -> tuple[float, float] | None:
+    """
+    Get the pick window of the user on the local clock.
+    The window is defined on the server clock, so it is shifted by the estimated clock offset and half the
+    round trip time: a request sent at the returned open time reaches the server as the window opens.
+    :param session: The user session to get the pick window for.
+    :return: A tuple of the open and close time in local epoch seconds, or None if the user can always pick.
+    """
+    api_config = session.get_config().pick_shift_api_config
+    if api_config.time_to_pick is None:
+        return None
+    time_to_pick = api_config.time_to_pick.replace(tzinfo=api_config.time_zone)
+    try:
+        closes = (time_to_pick + api_config.duration).timestamp()
+    except OverflowError:
+        closes = float("inf")
+    clock = get_server_clock()
+    return clock.send_time_for_arrival(time_to_pick.timestamp()), clock.send_time_for_arrival(closes)
 
 
 def __can_pick_shift(session: UserSession) -> bool:
@@ -17,30 +95,120 @@ def __can_pick_shift(session: UserSession) -> bool:
     :param session: The user session to check.
     :return: True if the user can pick a shift, False otherwise.
     """
-    time_to_pick = session.get_config().pick_shift_api_config.time_to_pick.replace(tzinfo=session.get_config().pick_shift_api_config.time_zone)
-    time_to_run = session.get_config().pick_shift_api_config.duration
-    if time_to_pick is None:
+    window = __get_pick_window(session)
+    if window is None:
         return True
-    if time.time() < time_to_pick.timestamp():
+    return window[0] <= time.time() < window[1]
+
+
+def is_standby(session: UserSession, now: float) -> bool:
+    """
+    Check if the session is inside the warm-up lead time ahead of its pick window.
+    :param session: The user session to check.
+    :param now: The current time in epoch seconds.
+    :return: True if the session should be pre-armed, False otherwise.
+    """
+    window = __get_pick_window(session)
+    if window is None:
         return False
-    try:
-        if (time_to_pick + time_to_run).timestamp() > time.time():
-            return True
-    except OverflowError:
-        return True
-    return False
+    lead_time = session.get_config().pick_shift_api_config.warm_up_lead_time.total_seconds()
+    return window[0] - lead_time <= now < window[0]
 
 
-async def __get_shifts(session: UserSession, start_time: str, end_time: str) -> list:
-    data = {
-        "operationName": "FindShiftsPage",
-        "query": r"""
-query FindShiftsPage(
-  $shiftOpportunitiesTimeRange: DateTimeRangeInput!
-  $opportunitiesOpportunityTypes: TypeFilter
-  $countTypes: TypeFilter
-) {
-  shiftOpportunities(timeRange: $shiftOpportunitiesTimeRange) {
+def get_window_open_time(session: UserSession) -> float | None:
+    """
+    Get the time the pick window of the session opens at.
+    :param session: The user session to check.
+    :return: The open time in epoch seconds, or None if the user can always pick.
+    """
+    window = __get_pick_window(session)
+    return None if window is None else window[0]
+
+
+def next_run_time(session: UserSession, now: float) -> float | None:
+    """
+    Get the next time the pick process should run for the given session.
+    :param session: The user session to check.
+    :param now: The current time in epoch seconds.
+    :return: The next run time in epoch seconds, or None if the pick window has already closed.
+    """
+    window = __get_pick_window(session)
+    if window is None:
+        return now + __poll_interval
+    lead_time = session.get_config().pick_shift_api_config.warm_up_lead_time.total_seconds()
+    if now < window[0] - lead_time:
+        return window[0] - lead_time
+    if now < window[0]:
+        return window[0]
+    if now < window[1]:
+        return now + __poll_interval
+    return None
+
+
+def compile_rules(config: UserConfig) -> IntervalIndex:
+    """
+    Compile the rules of the given config into an interval index. The plan built from the config holds it.
+    :param config: The user config to compile the rules of.
+    :return: The interval index of the rules.
+    """
+    time_zone = config.pick_shift_api_config.time_zone or timezone.utc
+    # Convert rules to list tuple of datetime objects in the user's timezone
+    rules = [(rule.start.replace(tzinfo=time_zone), rule.end.replace(tzinfo=time_zone))
+             for rule in config.pick_shift_api_config.rules]
+    return IntervalIndex(rules)
+
+
+async def prepare(session: UserSession) -> PickPlan:
+    """
+    Build the pick plan for the given session: resolve the employee ID, compile the rules and prebuild
+    the discovery request bodies.
+    :param session: The user session to prepare.
+    :return: The pick plan for the current config of the session.
+    """
+    config = session.get_config()
+    employee_id = await session.get_employee_id()
+    if employee_id is None:
+        raise RuntimeError(f"Employee ID could not be resolved for {config.username}")
+    rules = compile_rules(config)
+    # Only query the parts of the rules that are still ahead
+    windows = plan_windows(rules.get_intervals(), get_server_clock().now(), __query_max_window, __query_min_window,
+                           __query_parallelism, __query_merge_gap)
+    if not windows:
+        logging.info(f"All rules of {config.username} are in the past, nothing to discover")
+    requests = [__build_find_shifts_request(datetime.fromtimestamp(start, tz=timezone.utc).isoformat(),
+                                            datetime.fromtimestamp(end, tz=timezone.utc).isoformat())
+                for start, end in windows]
+    batch_request = __build_find_shifts_batch_request(requests) if __batch_discovery and len(requests) > 1 else None
+    count_probe_request = __build_count_probe_request(requests) if __count_probe and requests else None
+    return PickPlan(config=config, url=f"{__graphql_url}?{employee_id}", rules=rules,
+                    shift_filter=compile_shift_filter(config, rules), shift_value=compile_shift_value(config),
+                    find_shifts_requests=requests,
+                    find_shifts_batch_request=batch_request, count_probe_request=count_probe_request)
+
+
+async def __post(session: UserSession, url: str, data: dict):
+    """
+    Send a GraphQL request once the global dispatcher gives the user an in-flight slot.
+    :param session: The user session to send the request for.
+    :param url: The GraphQL URL of the user.
+    :param data: The request body.
+    :return: The response.
+    """
+    config = session.get_config()
+    async with get_dispatcher().slot(config.username, config.priority):
+        return await session.get_client().post(url, headers=__build_headers(), json=data,
+                                               timeout=get_timeout(EndpointClass.GRAPHQL))
+
+
+def __build_headers() -> dict:
+    return {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:138.0) Gecko/20100101 Firefox/138.0",
+        "x-atoz-client-id": "SCHEDULE_MANAGEMENT_SERVICE",
+        "x-atoz-client-request-id": nanoid()
+    }
+
+
+__SHIFT_OPPORTUNITIES_SELECTION = r"""
     opportunities(opportunityTypes: $opportunitiesOpportunityTypes) {
       eligibility {
         isEligible
@@ -64,8 +232,26 @@ query FindShiftsPage(
     counts(countTypes: $countTypes) {
       count
     }
-  }
-}
+"""
+
+
+def __build_find_shifts_request(start_time: str, end_time: str) -> dict:
+    """
+    Build the FindShiftsPage request body for the given time range.
+    :param start_time: The start of the time range, as an ISO string.
+    :param end_time: The end of the time range, as an ISO string.
+    :return: The request body.
+    """
+    return {
+        "operationName": "FindShiftsPage",
+        "query": f"""
+query FindShiftsPage(
+  $shiftOpportunitiesTimeRange: DateTimeRangeInput!
+  $opportunitiesOpportunityTypes: TypeFilter
+  $countTypes: TypeFilter
+) {{
+  shiftOpportunities(timeRange: $shiftOpportunitiesTimeRange) {{{__SHIFT_OPPORTUNITIES_SELECTION}  }}
+}}
         """,
         "variables": {
             "shiftOpportunitiesTimeRange": {
@@ -80,31 +266,292 @@ query FindShiftsPage(
             }
         }
     }
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:138.0) Gecko/20100101 Firefox/138.0",
-        "x-atoz-client-id": "SCHEDULE_MANAGEMENT_SERVICE",
-        "x-atoz-client-request-id": nanoid()
+
+
+def __build_find_shifts_batch_request(requests: list[dict]) -> dict:
+    """
+    Build one FindShiftsPage request body that queries the time ranges of several requests,
+    each under the alias `w<index>`.
+    :param requests: The single window request bodies to batch.
+    :return: The request body.
+    """
+    variables = {
+        "opportunitiesOpportunityTypes": {
+            "types": ["ADD"]
+        },
+        "countTypes": {
+            "types": ["ADD"]
+        }
+    }
+    parameters = []
+    selections = []
+    for i, data in enumerate(requests):
+        variables[f"timeRange{i}"] = data["variables"]["shiftOpportunitiesTimeRange"]
+        parameters.append(f"  $timeRange{i}: DateTimeRangeInput!\n")
+        selections.append(f"  w{i}: shiftOpportunities(timeRange: $timeRange{i}) {{{__SHIFT_OPPORTUNITIES_SELECTION}  }}\n")
+    return {
+        "operationName": "FindShiftsPage",
+        "query": f"""
+query FindShiftsPage(
+{"".join(parameters)}  $opportunitiesOpportunityTypes: TypeFilter
+  $countTypes: TypeFilter
+) {{
+{"".join(selections)}}}
+        """,
+        "variables": variables
+    }
+
+
+def __build_count_probe_request(requests: list[dict]) -> dict:
+    """
+    Build one request body that only fetches the opportunity counts of the time ranges of several requests,
+    each under the alias `w<index>`.
+    :param requests: The single window request bodies to probe.
+    :return: The request body.
+    """
+    variables = {
+        "countTypes": {
+            "types": ["ADD"]
+        }
+    }
+    parameters = []
+    selections = []
+    for i, data in enumerate(requests):
+        variables[f"timeRange{i}"] = data["variables"]["shiftOpportunitiesTimeRange"]
+        parameters.append(f"  $timeRange{i}: DateTimeRangeInput!\n")
+        selections.append(f"  w{i}: shiftOpportunities(timeRange: $timeRange{i}) {{\n"
+                          f"    counts(countTypes: $countTypes) {{\n      count\n    }}\n  }}\n")
+    return {
+        "operationName": "FindShiftsCounts",
+        "query": f"""
+query FindShiftsCounts(
+{"".join(parameters)}  $countTypes: TypeFilter
+) {{
+{"".join(selections)}}}
+        """,
+        "variables": variables
     }
-    url = f"https://atoz-api-us-east-1.amazon.work/graphql?{await session.get_employee_id()}"
-    response = await session.get_client().post(url, headers=headers, json=data)
+
+
+async def __post_batch(session: UserSession, url: str, data: dict, name: str) -> tuple[dict | None, bool]:
+    """
+    Send a batched request of aliased fields.
+    :param session: The user session to send the request for.
+    :param url: The GraphQL URL of the user.
+    :param data: The request body.
+    :param name: The name of the request, for logging.
+    :return: The response data, or None if the request failed, and whether the server rejected the request
+             as such, e.g. because it is too large. Timeouts and server errors are not a rejection.
+    """
+    try:
+        response = await __post(session, url, data)
+    except httpx.HTTPError as e:
+        logging.warning("%s failed: %s", name, e)
+        return None, False
+    if response.status_code != 200:
+        logging.warning("%s failed: %s", name, response.text)
+        return None, response.status_code in __batch_rejected_status_codes
+    try:
+        response_data = response.json()
+    except ValueError:
+        logging.warning("%s returned an invalid body: %s", name, response.text)
+        return None, False
+    if not isinstance(response_data, dict):
+        logging.warning("%s returned an invalid body: %s", name, response.text)
+        return None, False
+    # Errors raised while executing a field carry its path, errors of the request itself do not
+    errors = response_data.get("errors") or []
+    if errors and not any(isinstance(error, dict) and error.get("path") for error in errors):
+        logging.warning("%s was rejected: %s", name, errors)
+        return None, True
+    return response_data, False
+
+
+async def __probe_counts(session: UserSession, plan: PickPlan) -> list[int | None] | None:
+    """
+    Get the opportunity count of every window with one counts-only request.
+    Probing is disabled for the rest of the window if the server rejects the probe.
+    :param session: The user session to probe for.
+    :param plan: The pick plan holding the count probe request.
+    :return: The count of each window, None for a window the probe did not answer,
+             or None if the probe failed.
+    """
+    response_data, rejected = await __post_batch(session, plan.url, plan.count_probe_request, "Shift count probe")
+    if response_data is None:
+        if rejected:
+            plan.probe_counts = False
+        return None
+    probe = response_data.get("data")
+    if not isinstance(probe, dict):
+        logging.warning("Shift count probe failed: %s", response_data.get("errors"))
+        return None
+    counts = []
+    for i in range(len(plan.find_shifts_requests)):
+        shift_opportunities = probe.get(f"w{i}")
+        if not isinstance(shift_opportunities, dict) or "counts" not in shift_opportunities:
+            counts.append(None)
+            continue
+        counts.append(__get_shift_count({"data": {"shiftOpportunities": shift_opportunities}}))
+    if all(count is None for count in counts):
+        logging.warning("Shift count probe failed: %s", response_data.get("errors"))
+        return None
+    return counts
+
+
+async def __get_shifts(session: UserSession, url: str, data: dict) -> list | None:
+    time_range = data["variables"]["shiftOpportunitiesTimeRange"]
+    start_time, end_time = time_range["start"], time_range["end"]
+    try:
+        response = await __post(session, url, data)
+    except httpx.HTTPError as e:
+        logging.error("Failed to get shifts: %s", e)
+        return None
 
     async def handle_response():
         if response.status_code != 200:
             logging.error("Failed to get shifts: %s", response.text)
-            return []
+            return None
 
-        response_data = response.json()
-        if not __validate_response_data(response_data):
-            logging.error("Invalid response data: %s", response_data)
-            return []
+        try:
+            response_data = response.json()
+        except ValueError:
+            logging.error("Shift discovery returned an invalid body: %s", response.text)
+            return None
+        return __parse_shift_opportunities(response_data, start_time, end_time)
 
-        if __get_shift_count(response_data) == 0:
-            logging.debug(f"No shifts available for {start_time} to {end_time}")
-            return []
+    return await create_task(handle_response())
 
-        return __filter_out_ineligible_shifts(response_data["data"]["shiftOpportunities"]["opportunities"])
 
-    return await create_task(handle_response())
+async def __get_shifts_batch(session: UserSession, plan: PickPlan, data: dict,
+                             requests: list[dict]) -> list[list | None] | None:
+    """
+    Get the shifts of several windows with one batched request.
+    Batched discovery is disabled for the rest of the window if the server rejects the batch.
+    :param session: The user session to get the shifts for.
+    :param plan: The pick plan.
+    :param data: The batched request body.
+    :param requests: The single window request bodies the batch was built from, in alias order.
+    :return: The opportunities of each window, None for a window the batch did not answer,
+             or None if the batch failed.
+    """
+    response_data, rejected = await __post_batch(session, plan.url, data, "Batched shift discovery")
+    if response_data is None:
+        if rejected:
+            plan.batch_discovery = False
+        return None
+    batch = response_data.get("data")
+    if not isinstance(batch, dict):
+        logging.warning("Batched shift discovery failed: %s", response_data.get("errors"))
+        return None
+    results = []
+    for i, window in enumerate(requests):
+        shift_opportunities = batch.get(f"w{i}")
+        if shift_opportunities is None:
+            results.append(None)
+            continue
+        time_range = window["variables"]["shiftOpportunitiesTimeRange"]
+        results.append(__parse_shift_opportunities({"data": {"shiftOpportunities": shift_opportunities}},
+                                                   time_range["start"], time_range["end"]))
+    if all(result is None for result in results):
+        logging.warning("Batched shift discovery failed: %s", response_data.get("errors"))
+        return None
+    return results
+
+
+async def __discover_shifts(session: UserSession, plan: PickPlan, opportunities: OpportunityCache,
+                            on_shifts: Callable[[list, Callable[[], None]], Awaitable[None]]) -> bool:
+    """
+    Get the opportunities of the windows of the plan, batched into one request when possible.
+    Once every window was fetched, a counts-only probe runs first and only the windows whose count changed
+    since their last fetch are fetched, except for a periodic full fetch. Windows the batch did not answer
+    are queried one request each.
+    :param session: The user session to get the shifts for.
+    :param plan: The pick plan.
+    :param opportunities: The state of the opportunities the session has seen.
+    :param on_shifts: Called with the opportunities of each response as soon as it is parsed, and a callback
+                      that records the count of the window once the picks of its opportunities finished.
+    :return: True if every window was fetched in full.
+    """
+    requests = plan.find_shifts_requests
+    windows = list(range(len(requests)))
+    counts = None
+    started_at = time.time()
+    # Until every window has a count there is nothing to compare a probe with.
+    # Shifts due for a retry are still listed under an unchanged count, fetch everything to retry them
+    if plan.count_probe_request is not None and plan.probe_counts \
+            and all(i in plan.window_counts for i in windows) \
+            and started_at - plan.last_full_fetch < __full_fetch_interval \
+            and not opportunities.has_pending_retries(started_at):
+        counts = await __probe_counts(session, plan)
+        if counts is not None:
+            windows = [i for i in windows if counts[i] is None or counts[i] != plan.window_counts.get(i)]
+            # Nothing to fetch in an empty window, remember its count so a new opportunity shows up as a change
+            for i in [i for i in windows if counts[i] == 0]:
+                plan.window_counts[i] = 0
+                windows.remove(i)
+            if not windows:
+                logging.debug("No opportunity counts changed")
+                return False
+
+    fetched = set()
+
+    async def handle_shifts(i: int, shifts: list | None):
+        if shifts is None:
+            return
+        fetched.add(i)
+
+        def settle():
+            # Only a fetch whose picks finished settles the count, anything else is fetched again next cycle.
+            # Without a probe, the fetched list stands in for the count of the window
+            plan.window_counts[i] = len(shifts) if counts is None or counts[i] is None else counts[i]
+
+        if shifts:
+            await on_shifts(shifts, settle)
+        else:
+            settle()
+
+    results = dict.fromkeys(windows)
+    if plan.find_shifts_batch_request is not None and plan.batch_discovery and len(windows) > 1:
+        batch_requests = [requests[i] for i in windows]
+        batch_request = plan.find_shifts_batch_request if len(windows) == len(requests) \
+            else __build_find_shifts_batch_request(batch_requests)
+        batch_results = await __get_shifts_batch(session, plan, batch_request, batch_requests)
+        if batch_results is not None:
+            results = dict(zip(windows, batch_results))
+    for i, result in results.items():
+        await handle_shifts(i, result)
+
+    async def get_shifts(i: int):
+        await handle_shifts(i, await __get_shifts(session, plan.url, requests[i]))
+
+    async with TaskGroup() as group:
+        for i, result in results.items():
+            if result is None:
+                group.create_task(get_shifts(i))
+
+    if len(fetched) < len(requests):
+        return False
+    plan.last_full_fetch = started_at
+    return True
+
+
+def __parse_shift_opportunities(response_data: dict, start_time: str, end_time: str) -> list | None:
+    """
+    Get the opportunities from a FindShiftsPage response.
+    :param response_data: The response data, with the opportunities under `data.shiftOpportunities`.
+    :param start_time: The start of the queried time range, for logging.
+    :param end_time: The end of the queried time range, for logging.
+    :return: The opportunities, or None if the response is invalid.
+    """
+    if not __validate_response_data(response_data):
+        logging.error("Invalid response data: %s", response_data)
+        return None
+
+    if __get_shift_count(response_data) == 0:
+        logging.debug(f"No shifts available for {start_time} to {end_time}")
+        return []
+
+    return response_data["data"]["shiftOpportunities"]["opportunities"]
 
 
 def __validate_response_data(response: dict) -> bool:
@@ -113,11 +560,12 @@ def __validate_response_data(response: dict) -> bool:
     :param response: The response data to validate.
     :return: True if the response data is valid, False otherwise.
     """
-    if not "data" in response and "shiftOpportunities" in response["data"]:
+    data = response.get("data") if isinstance(response, dict) else None
+    if not isinstance(data, dict) or not isinstance(data.get("shiftOpportunities"), dict):
         return False
-    if not "opportunities" in response["data"]["shiftOpportunities"]:
+    if not "opportunities" in data["shiftOpportunities"]:
         return False
-    if not "counts" in response["data"]["shiftOpportunities"]:
+    if not "counts" in data["shiftOpportunities"]:
         return False
     return True
 
@@ -136,37 +584,13 @@ def __get_shift_count(response: dict) -> int:
     return 0
 
 
-def __filter_out_ineligible_shifts(shifts: list) -> list:
-    """
-    Filter out ineligible shifts from the list of shifts.
-    :param shifts: The list of shifts to filter.
-    :return: A list of eligible shifts.
-    """
-    eligible_shifts = []
-    for shift in shifts:
-        if shift["eligibility"]["isEligible"] and not shift["unavailability"]:
-            eligible_shifts.append(shift)
-        else:
-            logging.debug("Shift is not eligible: %s", shift)
-    return eligible_shifts
-
-
-def __get_shift_time_block(shift: dict) -> tuple[datetime, datetime]:
-    """
-    Get the start and end time of the shift.
-    :param shift: The shift to get the time block for.
-    :return: A tuple containing the start and end time of the shift.
-    """
-    start_time = datetime.fromisoformat(shift["shift"]["timeRange"]["start"])
-    end_time = datetime.fromisoformat(shift["shift"]["timeRange"]["end"])
-    return start_time, end_time
-
-
-async def __pick_shift(session: UserSession, shift: dict) -> bool:
+async def __pick_shift(session: UserSession, url: str, shift: dict) -> PickOutcome:
     """
     Pick the given shift.
     :param session: The user session to pick the shift for.
+    :param url: The GraphQL URL of the user.
     :param shift: The shift to pick.
+    :return: The outcome of the pick. HTTP errors are worth a retry, GraphQL errors are not.
     """
     # Build the request
     data = {
@@ -182,26 +606,28 @@ mutation AddShift($shiftOpportunityId: AddShiftInput!) {
             }
         }
     }
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:138.0) Gecko/20100101 Firefox/138.0",
-        "x-atoz-client-id": "SCHEDULE_MANAGEMENT_SERVICE",
-        "x-atoz-client-request-id": nanoid()
-    }
-    url = f"https://atoz-api-us-east-1.amazon.work/graphql?{await session.get_employee_id()}"
-
-    response = await session.get_client().post(url, headers=headers, json=data)
+    try:
+        response = await __post(session, url, data)
+    except httpx.HTTPError as e:
+        logging.error("Failed to pick shift: %s", e)
+        return PickOutcome(OpportunityState.RETRY, type(e).__name__)
 
     async def handle_response():
         if response.status_code != 200:
             logging.error("Failed to pick shift: %s", response.text)
-            return False
+            return PickOutcome(OpportunityState.RETRY, f"HTTP {response.status_code}")
 
-        response_data = response.json()
+        try:
+            response_data = response.json()
+        except ValueError:
+            logging.error("Pick shift returned an invalid body: %s", response.text)
+            return PickOutcome(OpportunityState.REJECTED, "invalid response body")
         if not __validate_pick_shift_response(response_data, shift):
             logging.error("Invalid response data: %s", response_data)
-            return False
+            errors = (response_data.get("errors") if isinstance(response_data, dict) else None) or [response_data]
+            return PickOutcome(OpportunityState.REJECTED, __get_error_reason(errors[0]))
 
-        return True
+        return PickOutcome(OpportunityState.PICKED)
 
     return await create_task(handle_response())
 
@@ -213,56 +639,198 @@ def __validate_pick_shift_response(response: dict, shift: dict) -> bool:
     :param shift: The shift that was picked.
     :return: True if the response data is valid, False otherwise.
     """
-    if not "data" in response and not "addShift" in response["data"]:
+    # A failed mutation is answered with `data: null` next to its errors
+    data = response.get("data") if isinstance(response, dict) else None
+    if not isinstance(data, dict) or "addShift" not in data:
         return False
 
-    return response["data"]["addShift"] == shift["id"]
+    return data["addShift"] == shift["id"]
 
 
-async def run(session: UserSession):
+def __get_error_reason(error) -> str:
     """
-    Run the pick shift process for the given session.
-    :param session: The user session to run the pick shift process for.
+    Get a short reason from a GraphQL error, or from an unexpected result.
     """
-    if not __can_pick_shift(session):
-        logging.debug("Not time to pick shift yet")
-        return
+    if isinstance(error, dict) and "message" in error:
+        return error["message"]
+    return str(error)
 
-    logging.debug(f"Running pick shift for {session.get_config().username}")
 
-    rules = session.get_config().pick_shift_api_config.rules
-    # Convert rules to list tuple of datetime objects
-    rules = [(rule.start, rule.end) for rule in rules]
-    # Update the rules to use the user's timezone
-    rules = [(rule[0].replace(tzinfo=session.get_config().pick_shift_api_config.time_zone or timezone.utc),
-              rule[1].replace(tzinfo=session.get_config().pick_shift_api_config.time_zone or timezone.utc)) for rule in rules]
-    # Get the minimum start time and maximum end time from the rules
-    min_start = min([rule[0] for rule in rules])
-    max_end = max([rule[1] for rule in rules])
-    # Split into time blocks of max 7 days
-    time_blocks = split_time_block(min_start, max_end, 7)
-
-    # Get the shifts for each time block
-    all_shifts = []
-    results = []
+async def __pick_shifts_batch(session: UserSession, plan: PickPlan, shifts: list[dict]) -> dict[str, PickOutcome] | None:
+    """
+    Pick several shifts with one request of aliased AddShift mutations, `s<index>` for each shift.
+    Batched picks are disabled for the rest of the window if the server rejects the batch.
+    :param session: The user session to pick the shifts for.
+    :param plan: The pick plan.
+    :param shifts: The shifts to pick.
+    :return: The outcome of each pick by shift ID, or None if the batch failed before its mutations ran.
+    """
+    parameters = ", ".join(f"$s{i}: AddShiftInput!" for i in range(len(shifts)))
+    selections = "".join(f"  s{i}: addShift(input: $s{i})\n" for i in range(len(shifts)))
+    data = {
+        "operationName": "AddShift",
+        "query": f"""
+mutation AddShift({parameters}) {{
+{selections}}}
+        """,
+        "variables": {f"s{i}": {"shiftOpportunityId": shift["id"]} for i, shift in enumerate(shifts)}
+    }
+    response_data, rejected = await __post_batch(session, plan.url, data, "Batched pick")
+    if response_data is None:
+        if rejected:
+            plan.batch_picks = False
+        return None
+    # The mutations ran, a failed one can null the whole data but its error still carries its alias
+    batch = response_data.get("data")
+    if not isinstance(batch, dict):
+        batch = {}
+    errors = {error["path"][0]: error for error in response_data.get("errors") or []
+              if isinstance(error, dict) and error.get("path")}
+    results = {}
+    for i, shift in enumerate(shifts):
+        alias = f"s{i}"
+        if alias in batch and __validate_pick_shift_response({"data": {"addShift": batch[alias]}}, shift):
+            results[shift["id"]] = PickOutcome(OpportunityState.PICKED)
+            continue
+        if alias not in batch and alias not in errors:
+            # The mutation may have run, look at the shift again next cycle rather than sending it again now
+            results[shift["id"]] = PickOutcome(OpportunityState.RETRY, "no result in batch")
+            continue
+        error = errors.get(alias, batch.get(alias))
+        logging.error("Failed to pick shift %s: %s", shift["id"], error)
+        results[shift["id"]] = PickOutcome(OpportunityState.REJECTED, __get_error_reason(error))
+    return results
+
+
+async def __pick_shifts(session: UserSession, plan: PickPlan, shifts: list[dict]) -> dict[str, PickOutcome]:
+    """
+    Pick the given shifts, in batches when possible. The shifts of a batch that failed before its mutations ran
+    are picked one request each.
+    :param session: The user session to pick the shifts for.
+    :param plan: The pick plan.
+    :param shifts: The shifts to pick.
+    :return: The outcome of each pick, by shift ID.
+    """
+    results = {}
+    if __batch_picks and plan.batch_picks and len(shifts) > 1:
+        batches = [shifts[i:i + __pick_batch_size] for i in range(0, len(shifts), __pick_batch_size)]
+        async with TaskGroup() as group:
+            tasks = [group.create_task(__pick_shifts_batch(session, plan, batch)) for batch in batches]
+        for task in tasks:
+            if task.result() is not None:
+                results.update(task.result())
+
     async with TaskGroup() as group:
-        for time_block in time_blocks:
-            start_time_str = time_block[0].astimezone(timezone.utc).isoformat()
-            end_time_str = time_block[1].astimezone(timezone.utc).isoformat()
-            results.append(group.create_task(__get_shifts(session, start_time_str, end_time_str)))
+        tasks = {shift["id"]: group.create_task(__pick_shift(session, plan.url, shift))
+                 for shift in shifts if shift["id"] not in results}
+    for shift_id, task in tasks.items():
+        results[shift_id] = task.result()
+    return results
 
-    for result in results:
-        all_shifts += result.result()
 
-    # Remove duplicates
-    all_shifts = {shift["id"]: shift for shift in all_shifts}.values()
+async def run(session: UserSession, plan: PickPlan | None = None) -> PickPlan | None:
+    """
+    Run the pick shift process for the given session.
+    :param session: The user session to run the pick shift process for.
+    :param plan: The pick plan prepared ahead of the window. It is rebuilt if missing or stale.
+    :return: The plan used, to pass to the next run.
+    """
+    if not __can_pick_shift(session):
+        logging.debug("Not time to pick shift yet")
+        return plan
 
-    # Process each shift
-    async with TaskGroup() as group:
-        for shift in all_shifts:
-            start_time, end_time = __get_shift_time_block(shift)
-            # Check if the shift is within any of the rules
-            if time_block_in_blocks((start_time, end_time), rules):
-                logging.debug(f"Picking shift: {shift}")
-                group.create_task(__pick_shift(session, shift))
+    logging.debug(f"Running pick shift for {session.get_config().username}")
 
+    if plan is None or not plan.is_valid_for(session):
+        plan = await prepare(session)
+
+    opportunities = session.get_opportunities()
+    opportunities.prune(time.time())
+    # Discovery feeds each response into the queue, picks are dispatched as soon as a response is filtered
+    queue: Queue[tuple[list, Callable[[], None]] | None] = Queue(maxsize=__pipeline_size)
+    seen_ids = set()
+    listed_ids = set()
+    results = {}
+    complete = False
+
+    async def discover():
+        nonlocal complete
+        complete = await __discover_shifts(session, plan, opportunities,
+                                           lambda shifts, settle: queue.put((shifts, settle)))
+        await queue.put(None)
+
+    async def pick(shifts: list[dict]):
+        candidates = [create_candidate(shift, plan.shift_value) for shift in shifts]
+        while candidates:
+            # Only one of overlapping shifts can be honoured, pick the best non-overlapping set
+            now = time.time()
+            selected = select_non_overlapping(candidates, opportunities.get_committed_blocks(now))
+            if not selected:
+                break
+            selected_ids = set()
+            for candidate in selected:
+                logging.debug(f"Picking shift: {candidate.shift}")
+                opportunities.mark_new(candidate.shift["id"], (candidate.start, candidate.end), now)
+                selected_ids.add(candidate.shift["id"])
+            # The rest are fallbacks, tried on the next pass if a pick they overlap fails
+            candidates = [candidate for candidate in candidates if candidate.shift["id"] not in selected_ids]
+            outcomes = await __pick_shifts(session, plan, [candidate.shift for candidate in selected])
+            now = time.time()
+            for shift_id, outcome in outcomes.items():
+                opportunities.record(shift_id, outcome, now)
+            results.update(outcomes)
+        if not candidates:
+            return
+        now = time.time()
+        picked_blocks = opportunities.get_committed_blocks(now, in_flight=False)
+        for candidate in candidates:
+            if any(start < candidate.end and candidate.start < end for start, end in picked_blocks):
+                opportunities.mark_rejected(candidate.shift["id"], "overlaps a picked shift", now)
+            else:
+                # Overlaps a pick of another response still in flight, look at it again next cycle
+                opportunities.record(candidate.shift["id"], PickOutcome(OpportunityState.RETRY,
+                                                                        "overlaps a pick in flight"), now)
+
+    async def pick_window(shifts: list[dict], settle: Callable[[], None]):
+        await pick(shifts)
+        settle()
+
+    # Picks run in their own group, so a failed discovery does not cancel the mutations already sent
+    async with TaskGroup() as picks:
+        try:
+            async with TaskGroup() as group:
+                group.create_task(discover())
+                while (item := await queue.get()) is not None:
+                    shifts, settle = item
+                    listed_ids.update(shift["id"] for shift in shifts)
+                    now = time.time()
+                    matching_shifts = []
+                    for shift in shifts:
+                        # Remove duplicates across windows, and skip the shifts a previous cycle already settled
+                        if shift["id"] in seen_ids or not opportunities.should_pick(shift["id"], now):
+                            continue
+                        seen_ids.add(shift["id"])
+                        # Keep the shifts that match every constraint of the user
+                        reason = plan.shift_filter(shift)
+                        if reason is not None:
+                            logging.debug(f"Skipping shift {shift['id']}: {reason}")
+                            opportunities.mark_rejected(shift["id"], reason, now)
+                            continue
+                        matching_shifts.append(shift)
+                    if matching_shifts:
+                        picks.create_task(pick_window(matching_shifts, settle))
+                    else:
+                        settle()
+        except Exception as e:
+            logging.error(f"Shift discovery failed for {session.get_config().username}: {e!r}")
+            complete = False
+
+    # A retried shift missing from a full listing is gone, stop fetching everything to retry it
+    if complete:
+        opportunities.drop_unlisted_retries(listed_ids)
+
+    if results:
+        picked = sum(outcome.state == OpportunityState.PICKED for outcome in results.values())
+        logging.info(f"Picked {picked} of {len(results)} shifts for {session.get_config().username}, "
+                     f"tracking {len(opportunities)} opportunities")
+    return plan
@@ -0,0 +1,107 @@
+from bisect import bisect_right
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable
+
+from app.models import UserConfig, PickValue
+from api.shift_filter import normalize_skill
+
+# Returns the value of an opportunity given its start and end in epoch seconds
+ShiftValue = Callable[[dict, float, float], float]
+
+
+@dataclass
+class Candidate:
+    shift: dict
+    start: float
+    end: float
+    value: float
+
+
+def create_candidate(shift: dict, shift_value: ShiftValue) -> Candidate:
+    """
+    Wrap an opportunity with its time block in epoch seconds and its value.
+    """
+    time_range = shift["shift"]["timeRange"]
+    start = datetime.fromisoformat(time_range["start"]).timestamp()
+    end = datetime.fromisoformat(time_range["end"]).timestamp()
+    return Candidate(shift, start, end, shift_value(shift, start, end))
+
+
+def compile_shift_value(config: UserConfig) -> ShiftValue:
+    """
+    Compile the value function the pick selection maximizes for a user.
+
+    HOURS values an opportunity by the hours it covers. RULE_PRIORITY weighs those hours by one plus the highest
+    priority of the rules it overlaps, SKILL by the rank of its skill in `UserConfig.skills`, the first one
+    ranking highest.
+
+    :param config: The user config to compile.
+    :return: The value function.
+    """
+    api_config = config.pick_shift_api_config
+    if api_config.pick_value == PickValue.RULE_PRIORITY:
+        time_zone = api_config.time_zone or timezone.utc
+        rules = [(rule.start.replace(tzinfo=time_zone).timestamp(), rule.end.replace(tzinfo=time_zone).timestamp(),
+                  rule.priority) for rule in api_config.rules]
+
+        def value(shift: dict, start: float, end: float) -> float:
+            priority = max((rule[2] for rule in rules if rule[0] < end and start < rule[1]), default=0)
+            return (end - start) / 3600 * (1 + priority)
+
+        return value
+    if api_config.pick_value == PickValue.SKILL:
+        skills = config.skills or []
+        ranks = {normalize_skill(skill.value): len(skills) - i for i, skill in enumerate(skills)}
+
+        def value(shift: dict, start: float, end: float) -> float:
+            return (end - start) / 3600 * ranks.get(normalize_skill(shift.get("skill") or ""), 1)
+
+        return value
+    return lambda shift, start, end: (end - start) / 3600
+
+
+def __overlaps(blocks: list[tuple[float, float]], block_ends: list[float], start: float, end: float) -> bool:
+    # The only candidate is the first block ending after the start
+    i = bisect_right(block_ends, start)
+    return i < len(blocks) and blocks[i][0] < end
+
+
+def select_non_overlapping(candidates: list[Candidate], blocked: list[tuple[float, float]]) -> list[Candidate]:
+    """
+    Select the set of non-overlapping candidates with the highest total value (weighted interval scheduling),
+    leaving out candidates that overlap a blocked time block. Runs in O(n log n).
+
+    :param candidates: The candidates to select from.
+    :param blocked: The time blocks already taken, in epoch seconds.
+    :return: The selected candidates, ordered by end time.
+    """
+    blocked = sorted(blocked)
+    # Merge the blocked time blocks so overlap checks are a single bisect
+    merged: list[tuple[float, float]] = []
+    for start, end in blocked:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    merged_ends = [end for _, end in merged]
+    free = sorted((candidate for candidate in candidates
+                   if candidate.value > 0 and not __overlaps(merged, merged_ends, candidate.start, candidate.end)),
+                  key=lambda candidate: candidate.end)
+    ends = [candidate.end for candidate in free]
+    # best[j] is the highest value of the first j candidates, previous[j] the candidates compatible with the j-th
+    best = [0.0] * (len(free) + 1)
+    previous = [0] * (len(free) + 1)
+    for j, candidate in enumerate(free, 1):
+        previous[j] = bisect_right(ends, candidate.start, 0, j - 1)
+        best[j] = max(best[j - 1], best[previous[j]] + candidate.value)
+    selected = []
+    j = len(free)
+    while j > 0:
+        if best[previous[j]] + free[j - 1].value >= best[j - 1]:
+            selected.append(free[j - 1])
+            j = previous[j]
+        else:
+            j -= 1
+    selected.reverse()
+    return selected
@@ -0,0 +1,54 @@
+from datetime import datetime
+from typing import Callable
+
+from app.models import UserConfig
+from utils.time import IntervalIndex
+
+# Returns why an opportunity is not wanted, or None if it should be picked
+ShiftFilter = Callable[[dict], str | None]
+
+
+def normalize_skill(skill: str) -> str:
+    """
+    Normalize a skill name so "Ship Dock", "SHIP_DOCK" and "ship dock" compare equal.
+    """
+    return skill.replace("_", " ").casefold()
+
+
+def compile_shift_filter(config: UserConfig, rules: IntervalIndex) -> ShiftFilter:
+    """
+    Compile the constraints of a user into a single predicate over FindShiftsPage opportunities.
+
+    The predicate checks eligibility, unavailability, skills, duration bounds and rules in one pass, cheapest
+    first. Constraints the user did not configure are left out of it.
+
+    :param config: The user config to compile.
+    :param rules: The compiled rules of the user.
+    :return: The predicate.
+    """
+    api_config = config.pick_shift_api_config
+    skills = None if not config.skills else frozenset(normalize_skill(skill.value) for skill in config.skills)
+    min_duration = None if api_config.min_shift_duration is None else api_config.min_shift_duration.total_seconds()
+    max_duration = None if api_config.max_shift_duration is None else api_config.max_shift_duration.total_seconds()
+
+    def check(opportunity: dict) -> str | None:
+        if not opportunity["eligibility"]["isEligible"]:
+            return "not eligible"
+        unavailability = opportunity["unavailability"]
+        if unavailability:
+            reasons = unavailability.get("reasons") if isinstance(unavailability, dict) else unavailability
+            return f"unavailable: {reasons}"
+        if skills is not None and normalize_skill(opportunity.get("skill") or "") not in skills:
+            return f"skill {opportunity.get('skill')} not wanted"
+        time_range = opportunity["shift"]["timeRange"]
+        start = datetime.fromisoformat(time_range["start"]).timestamp()
+        end = datetime.fromisoformat(time_range["end"]).timestamp()
+        if min_duration is not None and end - start < min_duration:
+            return "shorter than the minimum duration"
+        if max_duration is not None and end - start > max_duration:
+            return "longer than the maximum duration"
+        if not rules.contains_timestamps(start, end):
+            return "outside of the rules"
+        return None
+
+    return check
@@ -0,0 +1,221 @@
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+import httpx
+
+from app.models import UserConfig, obfuscate_2fa_method
+from two_factor.provider import get_provider
+from utils.session import LOGIN_HOST, create_httpx_async_client, get_timeout, EndpointClass, \
+    cookiejar_to_selenium_cookies
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+SUCCESS_URL_PATTERN = re.compile(r"/shifts|/home")
+REQUIRED_COOKIES = ("atoz-oauth-token", "atoz-refresh-token", "atoz-auth-session")
+# Pages that only carry hidden fields and post themselves with JavaScript, e.g. SAML responses, followed in a row
+MAX_AUTO_SUBMITS = int(os.getenv("HTTP_LOGIN_MAX_AUTO_SUBMITS", "5"))
+
+
+@dataclass
+class Form:
+    action: str
+    method: str
+    inputs: list[dict[str, str]] = field(default_factory=list)
+    # Label text by the ID of the input it describes
+    labels: dict[str, str] = field(default_factory=dict)
+
+    def find_input(self, element_id: str) -> dict[str, str] | None:
+        return next((attrs for attrs in self.inputs if attrs.get("id") == element_id), None)
+
+    def is_auto_submit(self) -> bool:
+        """
+        Check if the form only carries hidden fields, which a browser would post without user input.
+        """
+        fields = [attrs for attrs in self.inputs if attrs.get("type") not in ("submit", "button")]
+        return bool(fields) and all(attrs.get("type") == "hidden" for attrs in fields)
+
+    def get_data(self, values: dict[str, str] | None = None, button_id: str | None = None) -> dict[str, str]:
+        """
+        Build the submitted form data the way a browser would.
+
+        :param values: The values of the inputs to fill, by input ID.
+        :param button_id: The ID of the button clicked to submit the form.
+        :return: The form data.
+        """
+        values = values or {}
+        data = {}
+        for attrs in self.inputs:
+            name = attrs.get("name")
+            if not name:
+                continue
+            input_type = attrs.get("type", "text")
+            element_id = attrs.get("id")
+            if input_type in ("submit", "button", "image"):
+                if button_id is not None and element_id == button_id:
+                    data[name] = attrs.get("value", "")
+            elif input_type in ("radio", "checkbox"):
+                if element_id in values or ("checked" in attrs and not self.__has_checked_value(name, values)):
+                    data[name] = attrs.get("value", "on")
+            elif element_id in values:
+                data[name] = values[element_id]
+            else:
+                data[name] = attrs.get("value", "")
+        return data
+
+    def __has_checked_value(self, name: str, values: dict[str, str]) -> bool:
+        return any(attrs.get("name") == name and attrs.get("id") in values for attrs in self.inputs)
+
+
+class FormParser(HTMLParser):
+    """
+    Collect the forms of a page with their inputs, buttons and labels.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.forms: list[Form] = []
+        self.__form: Form | None = None
+        self.__label_for: str | None = None
+        self.__label_text: list[str] | None = None
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        attributes = {name: value or "" for name, value in attrs}
+        if tag == "form":
+            self.__form = Form(attributes.get("action", ""), attributes.get("method", "get").lower())
+            self.forms.append(self.__form)
+        elif self.__form is None:
+            return
+        elif tag == "input" or tag == "button":
+            if tag == "button":
+                attributes.setdefault("type", "submit")
+            self.__form.inputs.append(attributes)
+            # A label wrapping its input describes it without a `for` attribute
+            if self.__label_text is not None and self.__label_for is None and "id" in attributes:
+                self.__label_for = attributes["id"]
+        elif tag == "label":
+            self.__label_for = attributes.get("for")
+            self.__label_text = []
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "form":
+            self.__form = None
+        elif tag == "label" and self.__label_text is not None:
+            if self.__form is not None and self.__label_for:
+                self.__form.labels[self.__label_for] = " ".join("".join(self.__label_text).split())
+            self.__label_for = None
+            self.__label_text = None
+
+    def handle_data(self, data: str) -> None:
+        if self.__label_text is not None:
+            self.__label_text.append(data)
+
+
+def parse_forms(html: str) -> list[Form]:
+    """
+    Parse the forms of an HTML page.
+
+    :param html: The page.
+    :return: The forms, in document order.
+    """
+    parser = FormParser()
+    parser.feed(html)
+    parser.close()
+    return parser.forms
+
+
+class HttpLogin:
+    """
+    Login that replays the form sequence of the login pages with plain HTTP requests, without a browser.
+
+    The steps mirror the browser login: associate login, SAML SSO password step, 2FA option selection and
+    code verification. Pages that post themselves with JavaScript are submitted automatically. Any page that
+    does not look as expected raises a RuntimeError, so the caller can fall back to the browser login.
+    """
+
+    def __init__(self, config: UserConfig, login_url: str = LOGIN_HOST):
+        self.__config = config
+        self.__login_url = login_url
+
+    async def login(self) -> list[dict]:
+        """
+        Log in and collect the session cookies.
+
+        :return: The cookies in the format returned by Selenium.
+        """
+        logging.debug(f"Performing HTTP login for {self.__config.username}")
+        async with create_httpx_async_client() as client:
+            client.headers["User-Agent"] = USER_AGENT
+            response = await self.__request(client, "GET", self.__login_url)
+            # Enter username
+            response = await self.__submit(client, response, "associate-login-input",
+                                           {"associate-login-input": self.__config.username}, "login-form-login-btn")
+            self.__expect_url(response, "SAML2/Unsolicited/SSO")
+            # Enter password
+            response = await self.__submit(client, response, "password", {"password": self.__config.password},
+                                           "buttonLogin")
+            self.__expect_url(response, "idp/enter")
+            # Select the 2FA method
+            method, address = self.__config.two_factor_method
+            form = self.__find_form(response, "buttonContinue")
+            obfuscated_2fa_method = obfuscate_2fa_method(address, method=method)
+            option_id = next((element_id for element_id, text in form.labels.items() if text == obfuscated_2fa_method),
+                             None)
+            if option_id is None:
+                raise RuntimeError(f"2FA option {obfuscated_2fa_method} not offered")
+            requested_at = datetime.now(timezone.utc)
+            response = await self.__submit(client, response, "buttonContinue", {option_id: ""}, "buttonContinue")
+            # Enter the 2FA code
+            provider = get_provider(method)
+            if not await provider.authenticate_async(address):
+                raise ValueError("Failed to authenticate with the 2FA method")
+            code = await provider.wait_for_code_async(address, requested_at)
+            response = await self.__submit(client, response, "code", {"code": code}, "buttonVerifyIdentity")
+            # Ensure that the login was successful
+            if SUCCESS_URL_PATTERN.search(str(response.url)) is None:
+                raise RuntimeError(f"Login did not reach the landing page, ended at {response.url}")
+            missing = [name for name in REQUIRED_COOKIES if client.cookies.get(name) is None]
+            if missing:
+                raise RuntimeError(f"Cookies missing after login: {', '.join(missing)}")
+            return cookiejar_to_selenium_cookies(client.cookies.jar)
+
+    async def __submit(self, client: httpx.AsyncClient, response: httpx.Response, element_id: str,
+                       values: dict[str, str], button_id: str) -> httpx.Response:
+        """
+        Fill and submit the form holding the given element, then follow any self-submitting pages.
+        """
+        form = self.__find_form(response, element_id)
+        url = urljoin(str(response.url), form.action)
+        response = await self.__request(client, form.method.upper(), url, form.get_data(values, button_id))
+        for _ in range(MAX_AUTO_SUBMITS):
+            forms = parse_forms(response.text)
+            if len(forms) != 1 or not forms[0].is_auto_submit():
+                break
+            url = urljoin(str(response.url), forms[0].action)
+            response = await self.__request(client, forms[0].method.upper(), url, forms[0].get_data())
+        return response
+
+    async def __request(self, client: httpx.AsyncClient, method: str, url: str,
+                        data: dict[str, str] | None = None) -> httpx.Response:
+        if method == "GET":
+            response = await client.get(url, params=data, follow_redirects=True,
+                                        timeout=get_timeout(EndpointClass.LOGIN))
+        else:
+            response = await client.post(url, data=data, follow_redirects=True,
+                                         timeout=get_timeout(EndpointClass.LOGIN))
+        if response.status_code >= 400:
+            raise RuntimeError(f"Login request to {url} failed: {response.status_code}")
+        return response
+
+    def __find_form(self, response: httpx.Response, element_id: str) -> Form:
+        for form in parse_forms(response.text):
+            if form.find_input(element_id) is not None:
+                return form
+        raise RuntimeError(f"No form with #{element_id} on {response.url}")
+
+    def __expect_url(self, response: httpx.Response, fragment: str) -> None:
+        if fragment not in str(response.url):
+            raise RuntimeError(f"Expected a page matching {fragment}, got {response.url}")
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Optional, Callable
+
+from app.session import UserSession
+
+__login_workers = int(os.getenv("LOGIN_WORKERS", "2"))
+__login_queue: Optional["LoginQueue"] = None
+
+
+class LoginStatus(Enum):
+    QUEUED = "QUEUED"
+    IN_PROGRESS = "IN_PROGRESS"
+    READY = "READY"
+    FAILED = "FAILED"
+
+
+class LoginQueue:
+    """
+    Queue of full logins, run by a bounded pool of workers. Browser logins run on their own threads.
+
+    Each user is queued at most once at a time. Callers never wait on a login: they submit it and
+    consult its status, and are notified through `on_done` when it finished.
+    """
+
+    def __init__(self, workers: int, on_done: Optional[Callable[[str, LoginStatus], None]] = None):
+        self.__workers = workers
+        self.__on_done = on_done
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="login")
+        self.__queue: Optional[asyncio.Queue[str]] = None
+        self.__sessions: dict[str, tuple[UserSession, bool]] = {}
+        self.__status: dict[str, LoginStatus] = {}
+        self.__tasks: list[asyncio.Task] = []
+
+    def submit(self, session: UserSession, show_browser=False) -> LoginStatus:
+        """
+        Queue a login for the session unless one is already queued or running for the same user.
+        :param session: The session to log in.
+        :param show_browser: Show the browser window.
+        :return: The login status of the user after the call.
+        """
+        self.__ensure_started()
+        username = session.get_config().username
+        # Always log in the latest session object, a reload may have replaced it while queued
+        self.__sessions[username] = (session, show_browser)
+        status = self.__status.get(username)
+        if status in (LoginStatus.QUEUED, LoginStatus.IN_PROGRESS):
+            return status
+        self.__status[username] = LoginStatus.QUEUED
+        self.__queue.put_nowait(username)
+        logging.debug(f"Queued login for {username}")
+        return LoginStatus.QUEUED
+
+    def get_status(self, username: str) -> LoginStatus | None:
+        """
+        Get the login status of the given user.
+        :param username: The username to get the status for.
+        :return: The status, or None if no login was ever submitted for the user.
+        """
+        return self.__status.get(username)
+
+    def forget(self, username: str) -> None:
+        """
+        Drop a user from the queue, e.g. after its session was deleted. A queued login is skipped.
+        :param username: The username to forget.
+        """
+        self.__sessions.pop(username, None)
+        self.__status.pop(username, None)
+
+    async def stop(self) -> None:
+        """
+        Stop the workers. Logins already running on a thread are left to finish in the background.
+        """
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks.clear()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def __ensure_started(self) -> None:
+        if self.__tasks:
+            return
+        self.__queue = asyncio.Queue()
+        self.__tasks = [asyncio.create_task(self.__work(), name=f"login-worker-{i}") for i in range(self.__workers)]
+
+    async def __work(self) -> None:
+        while True:
+            username = await self.__queue.get()
+            try:
+                entry = self.__sessions.get(username)
+                if entry is None or entry[0].is_closed():
+                    logging.debug(f"Skipping login for removed session {username}")
+                    self.__status.pop(username, None)
+                    continue
+                session, show_browser = entry
+                self.__status[username] = LoginStatus.IN_PROGRESS
+                logging.info(f"Logging in {username}")
+                success = await session.login(show_browser, self.__executor)
+                status = LoginStatus.READY if success else LoginStatus.FAILED
+                if username in self.__status:
+                    self.__status[username] = status
+                logging.info(f"Login for {username} finished: {status.value}")
+                if self.__on_done is not None:
+                    self.__on_done(username, status)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error logging in {username}: {e}")
+                self.__status[username] = LoginStatus.FAILED
+            finally:
+                self.__queue.task_done()
+
+
+def get_login_queue(on_done: Optional[Callable[[str, LoginStatus], None]] = None) -> LoginQueue:
+    """
+    Get the login queue shared by every session, creating it on first use.
+    :param on_done: Called with the username and final status whenever a login finishes. Only used on creation.
+    """
+    global __login_queue
+    if __login_queue is None:
+        __login_queue = LoginQueue(__login_workers, on_done)
+    return __login_queue
@@ -8,6 +8,11 @@ from zoneinfo import ZoneInfo
 class TwoFAMethod(Enum):
     OUTLOOK = "OUTLOOK"
 
+class PickValue(Enum):
+    HOURS = "HOURS"
+    RULE_PRIORITY = "RULE_PRIORITY"
+    SKILL = "SKILL"
+
 class SkillType(Enum):
     INBOUND = "Inbound"
     SHIP_DOCK = "Ship Dock"
@@ -17,6 +22,7 @@ class SkillType(Enum):
 class ShiftBlockConfig:
     start: datetime
     end: datetime
+    priority: int = 0
 
 @dataclass
 class PickShiftApiConfig:
@@ -24,6 +30,10 @@ class PickShiftApiConfig:
     time_zone: Optional[ZoneInfo]
     rules: list[ShiftBlockConfig]
     duration: timedelta = timedelta(hours=1)
+    warm_up_lead_time: timedelta = timedelta(seconds=30)
+    min_shift_duration: Optional[timedelta] = None
+    max_shift_duration: Optional[timedelta] = None
+    pick_value: PickValue = PickValue.HOURS
 
 @dataclass
 class UserConfig:
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from app.session import UserSession, EXPIRATION_MARGIN
+from utils.scheduler import DeadlineScheduler
+
+__refresh_lead = float(os.getenv("REFRESH_LEAD", "600"))
+__refresh_jitter = float(os.getenv("REFRESH_JITTER", "180"))
+__refresh_min_interval = float(os.getenv("REFRESH_MIN_INTERVAL", "60"))
+__refresh_idle_interval = float(os.getenv("REFRESH_IDLE_INTERVAL", "60"))
+__refresh_retry_base = float(os.getenv("REFRESH_RETRY_BASE", "2"))
+__refresh_retry_max = float(os.getenv("REFRESH_RETRY_MAX", "60"))
+
+
+@dataclass
+class RefreshSettings:
+    """
+    Timing of the background token refresh, in seconds.
+    """
+    lead: float
+    jitter: float
+    min_interval: float
+    idle_interval: float
+    retry_base: float
+    retry_max: float
+
+
+def get_refresh_settings() -> RefreshSettings:
+    """
+    Get the refresh settings configured through the environment.
+    """
+    return RefreshSettings(__refresh_lead, __refresh_jitter, __refresh_min_interval, __refresh_idle_interval,
+                           __refresh_retry_base, __refresh_retry_max)
+
+
+class SessionRefresher:
+    """
+    Background task that refreshes the tokens of a session well before `refresh_session_expiration`,
+    so neither the pick path nor a full browser login ever has to pay for it.
+    """
+
+    def __init__(self, session: UserSession, scheduler: DeadlineScheduler, settings: RefreshSettings):
+        self.__session = session
+        self.__scheduler = scheduler
+        self.__settings = settings
+        self.__key = f"refresh:{session.get_config().username}"
+        self.__task: Optional[asyncio.Task] = None
+        self.__last_refresh = 0.0
+
+    def start(self) -> None:
+        """
+        Start the refresh task.
+        """
+        if self.__task is not None:
+            raise RuntimeError("Refresher is already running")
+        self.__task = asyncio.create_task(self.__run(), name=self.__key)
+
+    async def stop(self) -> None:
+        """
+        Cancel the refresh task and wait for it to finish.
+        """
+        if self.__task is None:
+            return
+        self.__task.cancel()
+        try:
+            await self.__task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"Refresher for {self.__session.get_config().username} stopped with error: {e}")
+
+    def wake(self) -> None:
+        """
+        Re-evaluate the refresh deadline, e.g. after a login replaced the session cookies.
+        """
+        self.__scheduler.wake(self.__key)
+
+    async def __run(self) -> None:
+        username = self.__session.get_config().username
+        while True:
+            try:
+                await self.__run_once(username)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Keep refreshing, e.g. a malformed expiration cookie is replaced by the next login
+                logging.error(f"Error in token refresh for {username}: {e}")
+                await self.__scheduler.sleep_until(self.__key, time.time() + self.__settings.idle_interval)
+
+    async def __run_once(self, username: str) -> None:
+        """
+        Sleep until the next refresh is due and run it.
+        """
+        now = time.time()
+        expiration = self.__session.get_session_expiration()
+        if expiration is None:
+            # Nothing to refresh until the session is logged in
+            await self.__scheduler.sleep_until(self.__key, now + self.__settings.idle_interval)
+            return
+        # Spread refreshes across users so a fleet does not hit the login host at the same moment
+        due = expiration - self.__settings.lead - random.uniform(0, self.__settings.jitter)
+        due = max(due, self.__last_refresh + self.__settings.min_interval)
+        if due > now:
+            logging.debug(f"Next token refresh for {username} in {due - now:.0f}s")
+            reached = await self.__scheduler.sleep_until(self.__key, due)
+            # Woken early or the cookies changed while sleeping, recompute the deadline
+            if not reached or expiration != self.__session.get_session_expiration():
+                return
+        await self.__refresh_with_backoff(expiration)
+
+    async def __refresh_with_backoff(self, expiration: int) -> None:
+        """
+        Refresh the session, retrying with exponential backoff until it succeeds or the session expires.
+        """
+        username = self.__session.get_config().username
+        attempt = 0
+        while True:
+            self.__last_refresh = time.time()
+            try:
+                if await self.__session.refresh(logout_on_failure=False):
+                    logging.info(f"Refreshed tokens for {username}")
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Error refreshing tokens for {username}: {e}")
+            delay = min(self.__settings.retry_max, self.__settings.retry_base * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+            attempt += 1
+            if time.time() + delay > expiration - EXPIRATION_MARGIN:
+                # Leave it to the supervisor, which falls back to a full login
+                logging.error(f"Giving up refreshing tokens for {username} after {attempt} attempts")
+                return
+            logging.warning(f"Failed to refresh tokens for {username}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
@@ -1,9 +1,11 @@
 import asyncio
 import logging
+import os
 import pathlib
 import re
 import time
-from asyncio import TaskGroup
+from concurrent.futures import Executor
+from datetime import datetime, timezone
 from os import PathLike
 from typing import Optional
 
@@ -11,20 +13,48 @@ import requests
 from httpx import AsyncClient
 from selenium.webdriver.common.by import By
 
-from app.models import UserConfig, obfuscate_2fa_method, TwoFAMethod
-from two_factor.outlook import authenticate, get_2fa_code
+from api.opportunities import OpportunityCache, create_opportunity_cache
+from app.http_login import HttpLogin
+from app.models import UserConfig, obfuscate_2fa_method
+from app.store import load_session as load_stored_session, save_session as save_stored_session, \
+    delete_session as delete_stored_session
+from two_factor.provider import get_provider
+from two_factor.waiter import wait_for_2fa_code
 from utils.browser import BrowserFirefox, get_2fa_options
-from utils.session import create_httpx_async_client
-from utils.time import is_time
+from utils.browser_pool import get_browser_pool
+from utils.session import create_httpx_async_client, warm_connections, get_timeout, EndpointClass, close_client, \
+    get_tracking_transport, cookiejar_to_selenium_cookies
 from utils.watcher import load_config
 
+# Maximum time to wait for in-flight requests before a client is closed
+DRAIN_TIMEOUT = float(os.getenv("SESSION_DRAIN_TIMEOUT", "10"))
+# Sessions are treated as expired this many seconds before `refresh_session_expiration`
+EXPIRATION_MARGIN = 60
+EMPLOYEE_ID_PATTERN = re.compile(r"""(?<=['\"]employeeId['\"]:['\"])\d{9}(?=['\"])""")
+# Characters kept between streamed chunks, longer than a full `"employeeId":"123456789"` match
+EMPLOYEE_ID_TAIL = 64
+# "http" replays the login forms without a browser and falls back to the browser login if it fails
+LOGIN_BACKEND = os.getenv("LOGIN_BACKEND", "browser").lower()
+
 
 class UserSession:
     def __init__(self, config: UserConfig):
-        self.__client = AsyncClient()
+        self.__client = create_httpx_async_client()
         self.__session = None
         self.__employee_id: Optional[int] = None
         self.__config = config
+        self.__created_at = time.time()
+        self.__retired_clients: list[AsyncClient] = []
+        self.__closed = False
+        self.__rehydrated = False
+        self.__employee_id_task: Optional[asyncio.Task] = None
+        self.__opportunities = create_opportunity_cache()
+
+    def get_created_at(self) -> float:
+        """
+        Get the time the user session was created at, in epoch seconds.
+        """
+        return self.__created_at
 
     def get_config(self) -> UserConfig:
         """
@@ -32,6 +62,13 @@ class UserSession:
         """
         return self.__config
 
+    def get_opportunities(self) -> OpportunityCache:
+        """
+        Get the state of the opportunities the session has seen. It survives config changes that keep the
+        same credentials, so picked shifts and their time blocks are not forgotten mid-window.
+        """
+        return self.__opportunities
+
     def get_session(self) -> requests.Session:
         """
         Get the request session.
@@ -47,8 +84,9 @@ class UserSession:
         if self.__should_re_login(config):
             # Re-authenticate if the configuration has changed
             # self.__session = requests.Session()
-            self.__client = AsyncClient()
+            self.__replace_client(create_httpx_async_client())
             self.__employee_id = None
+            self.__opportunities = create_opportunity_cache()
         self.__config = config
         logging.debug("User session config updated: %s", self.__config)
 
@@ -62,48 +100,114 @@ class UserSession:
     async def get_employee_id(self) -> int | None:
         """
         Get the employee ID from the session.
+        Concurrent callers share a single in-flight lookup.
         """
         if self.__employee_id is None:
-            # Fetch the employee ID from the session
-            url = "https://atoz.amazon.work/shifts"
+            if self.__employee_id_task is None or self.__employee_id_task.done():
+                self.__employee_id_task = asyncio.create_task(self.__fetch_employee_id())
+            # Shielded so a cancelled caller does not cancel the lookup the others are waiting on
+            self.__employee_id = await asyncio.shield(self.__employee_id_task)
+            if self.__employee_id is not None:
+                self.__persist()
+
+        return self.__employee_id
 
-            response = await self.__client.get(url)
+    async def __fetch_employee_id(self) -> int | None:
+        """
+        Fetch the employee ID from the shifts page.
+        The page is streamed and the download stops as soon as the ID has been found.
+        """
+        url = "https://atoz.amazon.work/shifts"
+        text = ""
+        async with self.__client.stream("GET", url, timeout=get_timeout(EndpointClass.PAGE)) as response:
             if response.status_code != 200:
                 logging.error("Failed to get employee ID from session")
                 return None
+            async for chunk in response.aiter_text():
+                # Keep a tail of the previous chunks so a match split across chunks is still found
+                text = text[-EMPLOYEE_ID_TAIL:] + chunk
+                match = EMPLOYEE_ID_PATTERN.search(text)
+                if match is not None:
+                    return int(match.group())
 
-            text = response.text
-            pattern = re.compile(r"""(?<=['\"]employeeId['\"]:['\"])\d{9}(?=['\"])""")
-            match = pattern.search(text)
-            if match is None:
-                logging.error(f"Employee ID not found in response for user session {self}")
-                return None
-
-            self.__employee_id = int(match.group())
+        logging.error(f"Employee ID not found in response for user session {self}")
+        return None
 
-        return self.__employee_id
-
-    async def authenticate(self, show_browser=False) -> bool:
+    async def restore(self) -> bool:
         """
-        Authenticate the user session.
+        Authenticate the user session without a browser: reuse the current or persisted cookies and
+        refresh them if they are about to expire.
+        :return: True if the session is ready, False if a full login is needed.
         """
+        if not self.__rehydrated:
+            self.__rehydrated = True
+            self.__rehydrate()
         if self.__is_session_valid() and not self.__is_session_expired():
             return True
         elif self.__is_session_valid() and self.__is_session_expired():
-            return await self.__re_authenticate()
-        else:
-            browser = BrowserFirefox(headless=not show_browser)
-            # Perform the login process
+            if await self.__re_authenticate():
+                self.__persist()
+                return True
+            logging.warning(f"Failed to re-authenticate user session {self}, falling back to login")
+            # Drop the dead cookies so the next attempt does not try to refresh them again
+            self.__replace_client(create_httpx_async_client())
+            self.__employee_id = None
+            delete_stored_session(self.__config.username)
+        return False
+
+    async def login(self, show_browser=False, executor: Optional[Executor] = None) -> bool:
+        """
+        Perform a full login for the user session, over HTTP if `LOGIN_BACKEND` is "http", else in a browser.
+        :param show_browser: Show the browser window.
+        :param executor: The executor the blocking browser login runs on. Defaults to the loop's default executor.
+        :return: True if the login succeeded, False otherwise.
+        """
+        cookies = None
+        if LOGIN_BACKEND == "http":
+            try:
+                cookies = await HttpLogin(self.__config).login()
+            except Exception as e:
+                logging.warning(f"HTTP login failed for {self.__config.username}, falling back to the browser: {e}")
+        # Perform the login process
+        if cookies is None:
             try:
-                cookies = await asyncio.to_thread(self.__login, browser)
+                cookies = await asyncio.get_running_loop().run_in_executor(executor, self.__login_with_pool,
+                                                                           show_browser)
             except Exception as e:
                 logging.error(f"Failed to login: {e}")
-                browser.stop()
                 return False
-            # Create a new session with the cookies
-            self.__client = create_httpx_async_client(selenium_cookie_list=cookies)
-            # Check if the session is valid
-            return self.__is_session_valid()
+        # Create a new session with the cookies
+        self.__replace_client(create_httpx_async_client(selenium_cookie_list=cookies))
+        # Check if the session is valid
+        if not self.__is_session_valid():
+            return False
+        self.__persist()
+        return True
+
+    def __rehydrate(self) -> None:
+        """
+        Restore the cookies and employee ID persisted by a previous run, if the session has none yet.
+        """
+        if self.__is_session_valid():
+            return
+        stored = load_stored_session(self.__config.username)
+        if stored is None:
+            return
+        self.__replace_client(create_httpx_async_client(selenium_cookie_list=stored.cookies))
+        self.__employee_id = stored.employee_id
+        logging.info(f"Restored stored session for {self.__config.username}")
+
+    def __persist(self) -> None:
+        """
+        Store the cookies and employee ID of the session so a restart can skip the login.
+        """
+        if not self.__is_session_valid():
+            return
+        # A deleted or reloaded session must not write its cookies back for the session replacing it
+        if self not in get_all_user_sessions():
+            return
+        cookies = cookiejar_to_selenium_cookies(self.__client.cookies.jar)
+        save_stored_session(self.__config.username, cookies, self.__employee_id)
 
     def __is_session_valid(self) -> bool:
         """
@@ -123,11 +227,40 @@ class UserSession:
         """
         Check if the session is expired.
         """
-        expiration_time = self.__client.cookies.get("refresh_session_expiration")
+        expiration_time = self.get_session_expiration()
         if expiration_time is None:
             return True
         current_time = time.time()
-        return current_time + 60 > int(expiration_time)
+        return current_time + EXPIRATION_MARGIN > expiration_time
+
+    def get_session_expiration(self) -> int | None:
+        """
+        Get the time the refresh session expires at, in epoch seconds.
+        """
+        expiration_time = self.__client.cookies.get("refresh_session_expiration")
+        if expiration_time is None:
+            return None
+        return int(expiration_time)
+
+    async def refresh(self, logout_on_failure=True) -> bool:
+        """
+        Refresh the access token of the session ahead of its expiration.
+        :param logout_on_failure: Log the session out if the refresh fails. Disable it for attempts that will be retried.
+        """
+        if not self.__is_session_valid():
+            return False
+        if not await self.__re_authenticate(logout_on_failure):
+            return False
+        self.__persist()
+        return True
+
+    async def warm(self, timeout: float | None = None) -> None:
+        """
+        Open connections to the GraphQL and login hosts so the first requests do not pay the TLS handshake.
+
+        :param timeout: The time in seconds to give up warming after, None to only bound each request.
+        """
+        await warm_connections(self.__client, timeout=timeout)
 
     async def logout(self) -> None:
         """
@@ -138,7 +271,7 @@ class UserSession:
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3",
         }
-        response = await self.__client.get(url, headers=headers)
+        response = await self.__client.get(url, headers=headers, timeout=get_timeout(EndpointClass.LOGIN))
         if response.status_code != 200:
             logging.error(f"Failed to logout: {response.status_code} - {response.text}")
 
@@ -150,9 +283,10 @@ class UserSession:
         """
         return f"UserSession(username={self.__config.username}, employee_id={self.__employee_id})"
 
-    async def __re_authenticate(self) -> bool:
+    async def __re_authenticate(self, logout_on_failure=True) -> bool:
         """
         Re-authenticate the user session.
+        :param logout_on_failure: Log the session out if the refresh fails. Disable it for attempts that will be retried.
         """
         logging.debug("Re-authenticating user session")
         # Build the URL and headers for the request
@@ -162,17 +296,19 @@ class UserSession:
             "anti-csrftoken-a2z-request": "true",
         }
         # Send the request to get the CSRF token
-        response = await self.__client.get(url, headers=headers)
+        response = await self.__client.get(url, headers=headers, timeout=get_timeout(EndpointClass.LOGIN))
         if response.status_code != 200:
             logging.error(f"Failed to get CSRF token: {response.status_code} - {response.text}")
-            await self.logout()
+            if logout_on_failure:
+                await self.logout()
             return False
 
         # Extract CSRF token from header
         csrf_token = response.headers.get("anti-csrftoken-a2z")
         if not csrf_token:
             logging.error(f"CSRF token not found in response headers for user session {self}")
-            await self.logout()
+            if logout_on_failure:
+                await self.logout()
             return False
         # Build the URL and headers for the refresh access token request
         url = "https://atoz-login.amazon.work/refresh_access_token"
@@ -181,13 +317,29 @@ class UserSession:
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3",
         }
         # Send the request to refresh the access token
-        response = await self.__client.post(url, headers=headers)
+        response = await self.__client.post(url, headers=headers, timeout=get_timeout(EndpointClass.LOGIN))
         if response.status_code != 200:
             logging.error(f"Failed to refresh access token: {response.status_code} - {response.text}")
-            await self.logout()
+            if logout_on_failure:
+                await self.logout()
             return False
 
         return True
+
+    def __login_with_pool(self, show_browser: bool) -> list:
+        """
+        Perform the login process on a browser borrowed from the pool.
+        """
+        pool = get_browser_pool(headless=not show_browser)
+        browser = pool.acquire()
+        healthy = False
+        try:
+            cookies = self.__login(browser)
+            healthy = True
+            return cookies
+        finally:
+            pool.release(browser, healthy)
+
     def __login(self, browser: BrowserFirefox) -> list:
         logging.debug("Performing login for user session %s", self)
         """
@@ -196,7 +348,6 @@ class UserSession:
         This method should handle the actual login logic, including
         entering the username and password, and handling two-factor authentication.
         """
-        browser.start()
         # Open the login page
         browser.get_url("https://atoz-login.amazon.work/")
         # Enter username
@@ -214,17 +365,16 @@ class UserSession:
             if option[0] == obfuscated_2fa_method:
                 option[1].click()
                 break
+        requested_at = datetime.now(timezone.utc)
         browser.find_element(By.ID, "buttonContinue").click()
         # Wait for the 2FA code input field to appear
-        time.sleep(20)
-        browser.find_element(By.ID, "code").send_keys(self.__get_2fa_code())
+        code_input = browser.find_element(By.ID, "code")
+        code_input.send_keys(self.__get_2fa_code(requested_at))
         browser.find_element(By.ID, "buttonVerifyIdentity").click()
         # Ensure that the login was successful
         browser.wait_for_url(regex=r"/shifts|/home", timeout=45)
         # Get the cookies from the browser
         cookies = browser.get_cookies()
-        # Stop the browser
-        browser.stop()
         # Return the cookies
         if not cookies:
             logging.error("No cookies found after login")
@@ -237,19 +387,58 @@ class UserSession:
         """
         return self.__client
 
-    def __get_2fa_code(self) -> str:
+    def __replace_client(self, client: AsyncClient) -> None:
+        """
+        Swap in a new client. The old one is closed by `release_retired_clients` once its requests drained,
+        since this can be called from the watcher thread.
+        """
+        self.__retired_clients.append(self.__client)
+        self.__client = client
+
+    async def release_retired_clients(self, drain_timeout: float = DRAIN_TIMEOUT) -> None:
+        """
+        Close the clients that were replaced since the last call.
+        """
+        retired, self.__retired_clients = self.__retired_clients, []
+        for client in retired:
+            await close_client(client, drain_timeout)
+
+    def is_closed(self) -> bool:
+        """
+        Check if the session has been closed.
+        """
+        return self.__closed
+
+    async def aclose(self, drain_timeout: float = DRAIN_TIMEOUT) -> None:
+        """
+        Close the session: wait for its in-flight requests, then close every client it owns.
+        """
+        if self.__closed:
+            return
+        self.__closed = True
+        await self.release_retired_clients(drain_timeout)
+        await close_client(self.__client, drain_timeout)
+        logging.debug(f"Closed user session {self}")
+
+    def get_open_connections(self) -> int:
         """
-        Get the 2FA code from the user.
+        Get the number of pooled connections held by the session, including clients waiting to be closed.
         """
-        method = self.__config.two_factor_method[0]
-        if method == TwoFAMethod.OUTLOOK:
-            if not authenticate(self.__config.two_factor_method[1]):
-                raise ValueError("Failed to authenticate with the 2FA method")
-            return get_2fa_code(self.__config.two_factor_method[1])
-        else:
-            raise ValueError(f"Unknown 2FA method type: {method}")
+        transports = [get_tracking_transport(client) for client in [self.__client, *self.__retired_clients]]
+        return sum(transport.get_open_connections() for transport in transports if transport is not None)
+
+    def __get_2fa_code(self, requested_at: datetime) -> str:
+        """
+        Wait for the 2FA code requested at the given time.
+        """
+        method, address = self.__config.two_factor_method
+        provider = get_provider(method)
+        if not provider.authenticate(address):
+            raise ValueError("Failed to authenticate with the 2FA method")
+        return wait_for_2fa_code(lambda received_after: provider.get_code(address, received_after), requested_at)
 
 __active_sessions: dict[str, tuple[UserSession, Optional[pathlib.Path]]] = {}
+__retired_sessions: list[UserSession] = []
 
 
 def create_user_session(config: UserConfig, path: Optional[pathlib.Path]) -> UserSession:
@@ -285,6 +474,8 @@ def delete_user_session(session: UserSession) -> None:
     username = session.get_config().username
     if username in __active_sessions:
         del __active_sessions[username]
+        # Closing needs the event loop, the watcher thread only hands the session over
+        __retired_sessions.append(session)
         logging.debug("Deleted user session for %s", username)
     else:
         logging.warning("Attempting to delete session for %s, but session doesn't exist", username)
@@ -296,6 +487,8 @@ def reload_user_session(session: UserSession) -> None:
         path = __active_sessions[username][1]
         # Delete the session
         delete_user_session(session)
+        # A scheduled reload asks for a fresh login, do not let the new session rehydrate the old cookies
+        delete_stored_session(username)
         # Create a new session with the same config
         data = load_config(path)
         if data is None:
@@ -305,45 +498,39 @@ def reload_user_session(session: UserSession) -> None:
     else:
         logging.warning("Attempting to reload session for %s, but session doesn't exist", username)
 
-async def authenticate_all_sessions(show_browser = False, single_user = None) -> list[UserSession]:
+def get_all_user_sessions() -> list[UserSession]:
+    """
+    Get a snapshot of all active user sessions.
+    """
+    return [session for (session, _) in list(__active_sessions.values())]
+
+
+def find_user_session_by_path(path: pathlib.Path) -> UserSession | None:
+    """
+    Find the user session that was loaded from the given config file.
+    """
+    for (session, session_path) in list(__active_sessions.values()):
+        if session_path is not None and pathlib.Path(session_path) == path:
+            return session
+    return None
+
+
+async def close_retired_sessions(drain_timeout: float = DRAIN_TIMEOUT) -> None:
+    """
+    Close the sessions that were deleted or reloaded since the last call.
+    """
+    while __retired_sessions:
+        await __retired_sessions.pop().aclose(drain_timeout)
+
+
+async def shutdown_all_sessions(drain_timeout: float = DRAIN_TIMEOUT) -> None:
     """
-    Authenticate all user sessions.
-    This method will iterate through all active sessions and authenticate them.
-    :return: A list of authenticated sessions.
+    Remove every session from the registry, drain their in-flight requests and close them.
     """
-    authenticated = []
-    results = {}
-    if single_user is not None and single_user in __active_sessions:
-
-        # If a single user is specified, only authenticate that user
-        session = __active_sessions[single_user][0]
-        # Check to see if session needs to be reloaded
-        if session.get_config().reload_session_on is not None and is_time(session.get_config().reload_session_on):
-            reload_user_session(session)
-        results[session] = await session.authenticate(show_browser)
-        if results[session]:
-            authenticated.append(session)
-            logging.debug(f"Authenticated session for {session.get_config().username}")
-        else:
-            logging.error(f"Failed to authenticate session for {session.get_config().username}")
-
-        return authenticated
-
-    for username, (session, _) in __active_sessions.items():
-        # Check to see if session needs to be reloaded
-        if session.get_config().reload_session_on is not None and is_time(session.get_config().reload_session_on):
-            reload_user_session(session)
-
-    async with TaskGroup() as group:
-        for (session, _) in __active_sessions.values():
-            # Create a task for each session
-            results[session] = group.create_task(session.authenticate(show_browser))
-
-    for session, task in results.items():
-        if task.result():
-            authenticated.append(session)
-            logging.debug(f"Authenticated session for {session.get_config().username}")
-        else:
-            logging.error(f"Failed to authenticate session for {session.get_config().username}")
-
-    return authenticated
\ No newline at end of file
+    sessions = get_all_user_sessions()
+    __active_sessions.clear()
+    __retired_sessions.extend(sessions)
+    retired = list(__retired_sessions)
+    __retired_sessions.clear()
+    await asyncio.gather(*(session.aclose(drain_timeout) for session in retired))
+    logging.debug("Closed %d user sessions", len(retired))
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Optional
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    # cryptography not available, the session store stays disabled
+    Fernet = None
+    InvalidToken = Exception
+
+__store_path = Path(os.getenv("SESSION_STORE_PATH", "session_store"))
+__store_key = os.getenv("SESSION_STORE_KEY")
+__fernet = None
+
+
+@dataclass
+class StoredSession:
+    cookies: list[dict]
+    employee_id: Optional[int]
+    saved_at: float
+
+
+def __get_fernet():
+    """
+    Get the cipher used to encrypt the stored sessions.
+    :return: The cipher, or None if the session store is disabled.
+    """
+    global __fernet
+    if __fernet is None and __store_key:
+        if Fernet is None:
+            logging.warning("SESSION_STORE_KEY is set but the cryptography package is not installed, "
+                            "sessions will not be persisted")
+            return None
+        try:
+            __fernet = Fernet(__store_key)
+        except ValueError as e:
+            logging.error(f"Invalid SESSION_STORE_KEY, sessions will not be persisted: {e}")
+            return None
+    return __fernet
+
+
+def __get_session_file(username: str) -> Path:
+    """
+    Get the file a user's session is stored in. The username is hashed so it does not appear on disk.
+    """
+    return __store_path / f"{hashlib.sha256(username.encode()).hexdigest()}.session"
+
+
+def save_session(username: str, cookies: list[dict], employee_id: Optional[int]) -> None:
+    """
+    Encrypt and store the session of the given user.
+    :param username: The username the session belongs to.
+    :param cookies: The cookies of the session, in the Selenium cookie format.
+    :param employee_id: The resolved employee ID, if any.
+    """
+    fernet = __get_fernet()
+    if fernet is None:
+        return
+    data = json.dumps(asdict(StoredSession(cookies=cookies, employee_id=employee_id, saved_at=time.time())))
+    path = __get_session_file(username)
+    try:
+        __store_path.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a truncated session behind
+        temp_path = path.with_suffix(".tmp")
+        with open(temp_path, "wb") as f:
+            f.write(fernet.encrypt(data.encode()))
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, path)
+        logging.debug(f"Stored session for {username}")
+    except OSError as e:
+        logging.error(f"Failed to store session for {username}: {e}")
+
+
+def load_session(username: str) -> StoredSession | None:
+    """
+    Load and decrypt the stored session of the given user.
+    :param username: The username to load the session for.
+    :return: The stored session, or None if there is none or it cannot be read.
+    """
+    fernet = __get_fernet()
+    if fernet is None:
+        return None
+    path = __get_session_file(username)
+    if not path.is_file():
+        return None
+    try:
+        with open(path, "rb") as f:
+            data = json.loads(fernet.decrypt(f.read()))
+        return StoredSession(**data)
+    except (OSError, ValueError, TypeError, InvalidToken) as e:
+        logging.error(f"Failed to load stored session for {username}: {e}")
+        return None
+
+
+def delete_session(username: str) -> None:
+    """
+    Delete the stored session of the given user.
+    :param username: The username to delete the session for.
+    """
+    path = __get_session_file(username)
+    try:
+        path.unlink(missing_ok=True)
+    except OSError as e:
+        logging.error(f"Failed to delete stored session for {username}: {e}")
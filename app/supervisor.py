@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Optional
+
+from api import pick_shifts
+from app.models import UserConfig
+from app.login_queue import LoginQueue, LoginStatus, get_login_queue
+from app.refresh import SessionRefresher, get_refresh_settings
+from app.session import UserSession, get_all_user_sessions, reload_user_session, close_retired_sessions, \
+    EXPIRATION_MARGIN
+from utils.scheduler import DeadlineScheduler
+from utils.time import is_time
+
+__auth_retry_interval = float(os.getenv("AUTH_RETRY_INTERVAL", "30"))
+__max_idle_interval = float(os.getenv("SUPERVISOR_MAX_IDLE_INTERVAL", "300"))
+__lifecycle_key = "__lifecycle__"
+__scheduler = DeadlineScheduler()
+__supervisors: dict[str, "SessionSupervisor"] = {}
+
+# Margin used by `is_time` when checking `reload_session_on`
+RELOAD_MARGIN = timedelta(minutes=5)
+# Lower bound between two wake-ups caused by refresh or reload deadlines
+MIN_HOUSEKEEPING_INTERVAL = 1
+# Connections are warmed again this many seconds before the window opens, well inside the keep-alive expiry
+STANDBY_REWARM_LEAD = float(os.getenv("STANDBY_REWARM_LEAD", "2"))
+
+
+class SessionSupervisor:
+    """
+    Long-lived coroutine that owns the auth, discovery and pick cadence of a single user session.
+    """
+
+    def __init__(self, session: UserSession, scheduler: DeadlineScheduler, login_queue: LoginQueue,
+                 auth_retry_interval: float, max_idle_interval: float, show_browser=False):
+        self.__session = session
+        self.__scheduler = scheduler
+        self.__login_queue = login_queue
+        self.__auth_retry_interval = auth_retry_interval
+        self.__max_idle_interval = max_idle_interval
+        self.__show_browser = show_browser
+        self.__task: Optional[asyncio.Task] = None
+        self.__plan: Optional[pick_shifts.PickPlan] = None
+        self.__refresher = SessionRefresher(session, scheduler, get_refresh_settings())
+
+    def get_session(self) -> UserSession:
+        """
+        Get the user session supervised by this supervisor.
+        """
+        return self.__session
+
+    def start(self) -> None:
+        """
+        Start the supervisor task.
+        """
+        if self.__task is not None:
+            raise RuntimeError("Supervisor is already running")
+        self.__task = asyncio.create_task(self.__run(), name=f"supervisor-{self.__session.get_config().username}")
+        self.__refresher.start()
+
+    def is_running(self) -> bool:
+        """
+        Check if the supervisor task is still running.
+        """
+        return self.__task is not None and not self.__task.done()
+
+    async def stop(self) -> None:
+        """
+        Cancel the supervisor task and wait for it to finish.
+        """
+        if self.__task is None:
+            return
+        self.__task.cancel()
+        try:
+            await self.__task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"Supervisor for {self.__session.get_config().username} stopped with error: {e}")
+        await self.__refresher.stop()
+
+    async def __run(self) -> None:
+        username = self.__session.get_config().username
+        logging.debug(f"Supervisor started for {username}")
+        authenticated = False
+        while True:
+            was_authenticated, authenticated = authenticated, False
+            try:
+                config = self.__session.get_config()
+                # Check to see if session needs to be reloaded
+                if self.__should_reload(config):
+                    # The reloaded session gets its own supervisor on the next reconcile
+                    reload_user_session(self.__session)
+                    notify_sessions_changed()
+                    return
+                await self.__session.release_retired_clients()
+                # Only the browserless path runs here, full logins go through the login queue
+                authenticated = await self.__session.restore()
+                if authenticated and not was_authenticated:
+                    # A login or restored session brings a new expiration to track
+                    self.__refresher.wake()
+                if authenticated and pick_shifts.is_standby(self.__session, time.time()):
+                    await self.__arm()
+                elif authenticated:
+                    self.__plan = await pick_shifts.run(self.__session, self.__plan)
+                else:
+                    if self.__login_queue.get_status(username) == LoginStatus.FAILED:
+                        logging.error(f"Failed to authenticate session for {username}, retrying login")
+                    status = self.__login_queue.submit(self.__session, self.__show_browser)
+                    logging.debug(f"Session for {username} is waiting on its login: {status.value}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error in supervisor for {username}: {e}")
+            deadline = self.__next_deadline(time.time(), authenticated)
+            logging.debug(f"Supervisor for {username} sleeping for {deadline - time.time():.3f}s "
+                          f"with {self.__session.get_open_connections()} open connections")
+            await self.__scheduler.sleep_until(username, deadline)
+
+    async def __arm(self) -> None:
+        """
+        Put the session in hot standby ahead of its pick window: a refreshed session, a resolved employee ID,
+        prebuilt request bodies and a warm connection, so the first request leaves as soon as the window opens.
+        """
+        window_opens = pick_shifts.get_window_open_time(self.__session)
+        lead_time = self.__session.get_config().pick_shift_api_config.warm_up_lead_time.total_seconds()
+        expiration = self.__session.get_session_expiration()
+        # Refresh now rather than having the refresh fall due right after the window opens
+        if expiration is not None and expiration - EXPIRATION_MARGIN < window_opens + lead_time:
+            if not await self.__session.refresh():
+                logging.warning(f"Failed to refresh session ahead of pick window for {self.__session.get_config().username}")
+        if self.__plan is None or not self.__plan.is_valid_for(self.__session):
+            self.__plan = await pick_shifts.prepare(self.__session)
+            logging.info(f"Session armed ahead of pick window for {self.__session.get_config().username}")
+        # A slow host must not hold the first pick past the window opening
+        time_left = window_opens - time.time()
+        if time_left > 0:
+            await self.__session.warm(time_left)
+
+    def __should_reload(self, config: UserConfig) -> bool:
+        """
+        Check if the session is due for its `reload_session_on` reload and has not been reloaded for it yet.
+        """
+        if config.reload_session_on is None or not is_time(config.reload_session_on, RELOAD_MARGIN):
+            return False
+        return not self.__is_reloaded(config)
+
+    def __is_reloaded(self, config: UserConfig) -> bool:
+        return self.__session.get_created_at() >= config.reload_session_on.timestamp() - RELOAD_MARGIN.total_seconds()
+
+    def __next_deadline(self, now: float, authenticated: bool) -> float:
+        """
+        Get the earliest time this session has work to do: the pick window opening, the next poll inside
+        the window, the session refresh or the config reload.
+        """
+        config = self.__session.get_config()
+        deadlines = [self.__max_idle_interval]
+        if not authenticated:
+            deadlines.append(self.__auth_retry_interval)
+        else:
+            expiration = self.__session.get_session_expiration()
+            if expiration is not None:
+                deadlines.append(expiration - EXPIRATION_MARGIN - now)
+        if config.reload_session_on is not None and not self.__is_reloaded(config):
+            deadlines.append(config.reload_session_on.timestamp() - RELOAD_MARGIN.total_seconds() - now)
+        # Housekeeping that is already overdue is retried at a bounded rate instead of spinning
+        deadline = now + max(min(deadlines), MIN_HOUSEKEEPING_INTERVAL)
+        next_run = pick_shifts.next_run_time(self.__session, now)
+        if next_run is not None:
+            deadline = min(deadline, next_run)
+        if authenticated and pick_shifts.is_standby(self.__session, now):
+            rewarm = pick_shifts.get_window_open_time(self.__session) - STANDBY_REWARM_LEAD
+            if rewarm > now:
+                deadline = min(deadline, rewarm)
+        return deadline
+
+
+async def reconcile_supervisors(show_browser=False, single_user=None) -> None:
+    """
+    Start a supervisor for every active session that does not have one and stop the supervisors
+    whose session has been deleted or replaced.
+    :param show_browser: Show the browser window during logins.
+    :param single_user: If provided, only this user's session will be supervised.
+    """
+    sessions = {session.get_config().username: session for session in get_all_user_sessions()}
+    if single_user is not None:
+        sessions = {username: session for username, session in sessions.items() if username == single_user}
+
+    login_queue = get_login_queue(on_done=lambda username, _: wake_supervisor(username))
+    for username, supervisor in list(__supervisors.items()):
+        if sessions.get(username) is supervisor.get_session() and supervisor.is_running():
+            continue
+        del __supervisors[username]
+        await supervisor.stop()
+        if username not in sessions:
+            login_queue.forget(username)
+        logging.debug(f"Stopped supervisor for {username}")
+
+    for username, session in sessions.items():
+        if username in __supervisors:
+            continue
+        supervisor = SessionSupervisor(session, __scheduler, login_queue, __auth_retry_interval, __max_idle_interval,
+                                       show_browser)
+        __supervisors[username] = supervisor
+        supervisor.start()
+        logging.debug(f"Started supervisor for {username}")
+
+    # Deleted and reloaded sessions are closed once their supervisor is gone
+    await close_retired_sessions()
+
+
+async def stop_all_supervisors() -> None:
+    """
+    Stop every running supervisor.
+    """
+    for username in list(__supervisors.keys()):
+        await __supervisors.pop(username).stop()
+    await get_login_queue().stop()
+
+
+def wake_supervisor(username: str) -> None:
+    """
+    Wake the supervisor of the given user so it picks up config changes immediately.
+    Safe to call from the watcher thread.
+    """
+    __scheduler.wake(username)
+
+
+def notify_sessions_changed() -> None:
+    """
+    Wake the lifecycle loop so it reconciles supervisors immediately.
+    Safe to call from the watcher thread.
+    """
+    __scheduler.wake(__lifecycle_key)
+
+
+async def wait_for_sessions_change(timeout: float) -> None:
+    """
+    Sleep until the sessions change or the timeout passes.
+    :param timeout: The maximum time to sleep, in seconds.
+    """
+    await __scheduler.sleep_until(__lifecycle_key, time.time() + timeout)
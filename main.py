@@ -1,33 +1,44 @@
 import argparse
 import asyncio
 import logging
+import os
 import sys
-import time
-from asyncio import TaskGroup
 from pathlib import Path
 
 
-from api import pick_shifts
 from app.models import UserConfig
-from app.session import get_user_session, delete_user_session, create_user_session, authenticate_all_sessions
+from app.session import get_user_session, delete_user_session, create_user_session, find_user_session_by_path, \
+    shutdown_all_sessions
+from app.supervisor import reconcile_supervisors, stop_all_supervisors, wake_supervisor, notify_sessions_changed, \
+    wait_for_sessions_change
+from utils.browser_pool import get_browser_pool
 from utils.logger import setup_logging
 from utils.watcher import Watcher, load_config
 
 
 import dotenv
 
+__lifecycle_interval = float(os.getenv("SUPERVISOR_RECONCILE_INTERVAL", "5"))
+
 def on_user_config_change(data: UserConfig, path: str) -> None:
     session = get_user_session(data, Path(path))
     session.update_config(data)
+    wake_supervisor(data.username)
+    notify_sessions_changed()
 
 
-def on_user_config_delete(data: UserConfig, path: str) -> None:
-    session = get_user_session(data, Path(path))
+def on_user_config_delete(data: UserConfig | None, path: str) -> None:
+    session = find_user_session_by_path(Path(path))
+    if session is None:
+        logging.warning("No user session found for deleted config file: %s", path)
+        return
     delete_user_session(session)
+    notify_sessions_changed()
 
 
 def on_user_config_create(data: UserConfig, path: str) -> None:
     create_user_session(data, Path(path))
+    notify_sessions_changed()
 
 
 async def start(config_dir: Path, log_file: Path | None = None, debug: bool = False, show_browser=False, single_user=None) -> None:
@@ -50,28 +61,37 @@ async def start(config_dir: Path, log_file: Path | None = None, debug: bool = Fa
     # Initialize the directory watcher
     watcher = Watcher(config_dir, on_user_config_change, on_user_config_create, on_user_config_delete)
     watcher.start()
+    # Pre-launch the browsers used for logins in the background
+    get_browser_pool(headless=not show_browser).start()
     # Load existing user configurations
     load_existing_user_configs(config_dir)
-    # Main loop to keep the application running
+    # Main loop only manages the lifecycle of the per-session supervisors
     try:
         while True:
             try:
-                time.sleep(3)
-                authenticated_sessions = await authenticate_all_sessions(show_browser, single_user)
-                authenticated_sessions.sort(key = lambda x: x.get_config().priority, reverse=True)
-                async with TaskGroup() as group:
-                    for session in authenticated_sessions:
-                        group.create_task(pick_shifts.run(session))
+                await reconcile_supervisors(show_browser, single_user)
             except Exception as e:
-                logging.error(f"Error in TaskGroup: {e}")
-    except KeyboardInterrupt:
-        watcher.stop()
+                logging.error(f"Error reconciling supervisors: {e}")
+            await wait_for_sessions_change(__lifecycle_interval)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        await shutdown(watcher)
     except Exception as e:
         logging.error(f"An error occurred: {e}")
-        watcher.stop()
+        await shutdown(watcher)
         sys.exit(1)
 
 
+async def shutdown(watcher: Watcher) -> None:
+    """
+    Stop watching for config changes, stop the supervisors, close every session and stop the pooled browsers.
+    :param watcher: The directory watcher to stop.
+    """
+    watcher.stop()
+    await stop_all_supervisors()
+    await shutdown_all_sessions()
+    get_browser_pool().close()
+
+
 def load_existing_user_configs(config_dir: Path) -> None:
     configs = config_dir.rglob("*.toml")
     for config in configs:
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+import unittest
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+from utils.clock import ServerClock
+
+# The stand-in server runs this far ahead of the local clock, in seconds
+SKEW = 3600.3
+
+
+class SkewedDateHandler(BaseHTTPRequestHandler):
+    """
+    Answer every request with an empty page and a `Date` header from a clock running `SKEW` seconds ahead.
+    """
+
+    def do_HEAD(self):
+        self.send_response(204)
+        self.end_headers()
+
+    def date_time_string(self, timestamp=None):
+        return formatdate(time.time() + SKEW, usegmt=True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ServerClockTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SkewedDateHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    async def test_offset_converges_on_skewed_server(self):
+        clock = ServerClock()
+        async with httpx.AsyncClient(event_hooks=clock.event_hooks()) as client:
+            for _ in range(20):
+                await client.head(self.url)
+                # Spread the samples over different sub-second phases of the server clock
+                await asyncio.sleep(0.137)
+
+        # A Date header has second resolution, the samples narrow it down well below that
+        self.assertAlmostEqual(clock.get_offset(), SKEW, delta=0.25)
+        self.assertAlmostEqual(clock.now(), time.time() + SKEW, delta=0.25)
+
+    async def test_send_time_leads_by_half_the_round_trip(self):
+        clock = ServerClock()
+        async with httpx.AsyncClient(event_hooks=clock.event_hooks()) as client:
+            await client.head(self.url)
+
+        # A request sent at the returned time is in flight for half the round trip before it arrives
+        server_time = time.time() + SKEW + 10
+        self.assertGreater(clock.get_min_rtt(), 0)
+        self.assertLess(clock.send_time_for_arrival(server_time), server_time - clock.get_offset())
+
+    def test_invalid_date_is_ignored(self):
+        clock = ServerClock()
+
+        clock.observe("not a date", 100.0, 100.1)
+
+        self.assertEqual(clock.get_offset(), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import asyncio
+import unittest
+
+from utils.dispatcher import PriorityDispatcher
+
+
+class PriorityDispatcherTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_slots_go_to_highest_priority_first(self):
+        dispatcher = PriorityDispatcher(1, 1)
+        order = []
+        await dispatcher.acquire("holder", 0)
+
+        async def request(key: str, priority: int):
+            async with dispatcher.slot(key, priority):
+                order.append(key)
+
+        tasks = [asyncio.create_task(request(key, priority)) for key, priority in [("low", 1), ("high", 3), ("mid", 2)]]
+        await asyncio.sleep(0)
+        dispatcher.release("holder", 0)
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(order, ["high", "mid", "low"])
+
+    async def test_per_user_limit_passes_over_busy_user(self):
+        dispatcher = PriorityDispatcher(4, 1)
+        await dispatcher.acquire("a", 2)
+
+        blocked = asyncio.create_task(dispatcher.acquire("a", 2))
+        other = asyncio.create_task(dispatcher.acquire("b", 1))
+        await asyncio.sleep(0)
+
+        # The second request of `a` waits for its first one without holding `b` back
+        self.assertFalse(blocked.done())
+        self.assertTrue(other.done())
+
+        dispatcher.release("a", 2)
+        await asyncio.wait_for(blocked, 1)
+
+    async def test_cancelled_waiter_gives_back_its_slot(self):
+        dispatcher = PriorityDispatcher(1, 1)
+        await dispatcher.acquire("a", 1)
+        waiter = asyncio.create_task(dispatcher.acquire("b", 1))
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        dispatcher.release("a", 1)
+
+        await asyncio.wait_for(dispatcher.acquire("c", 1), 1)
+
+    async def test_stagger_holds_lower_tier_while_higher_is_busy(self):
+        dispatcher = PriorityDispatcher(4, 4, 0.2)
+        loop = asyncio.get_running_loop()
+        await dispatcher.acquire("high", 2)
+
+        started = loop.time()
+        await asyncio.wait_for(dispatcher.acquire("low", 1), 1)
+
+        self.assertGreaterEqual(loop.time() - started, 0.15)
+
+    async def test_stagger_skips_idle_higher_tier(self):
+        dispatcher = PriorityDispatcher(4, 4, 0.2)
+        loop = asyncio.get_running_loop()
+        await dispatcher.acquire("high", 2)
+        dispatcher.release("high", 2)
+
+        started = loop.time()
+        await asyncio.wait_for(dispatcher.acquire("low", 1), 1)
+
+        self.assertLess(loop.time() - started, 0.05)
+
+
+if __name__ == "__main__":
+    unittest.main()
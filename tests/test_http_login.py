@@ -0,0 +1,201 @@
+import threading
+import unittest
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import two_factor.provider as provider_module
+from app.http_login import HttpLogin, parse_forms
+from app.models import UserConfig, PickShiftApiConfig, TwoFAMethod, obfuscate_2fa_method
+from two_factor.provider import TwoFactorProvider, register_provider
+
+ADDRESS = "user@example.com"
+CODE = "123456"
+
+LOGIN_PAGE = """
+<form action="/associate" method="post">
+  <input type="text" id="associate-login-input" name="login">
+  <input type="hidden" name="csrf" value="login-token">
+  <button id="login-form-login-btn" name="action" value="login">Next</button>
+</form>
+"""
+# Posted by JavaScript in a browser
+SAML_REQUEST_PAGE = """
+<form action="/saml" method="post"><input type="hidden" name="SAMLRequest" value="request"></form>
+"""
+PASSWORD_PAGE = """
+<form action="/SAML2/Unsolicited/SSO" method="post">
+  <input type="password" id="password" name="password">
+  <input type="submit" id="buttonLogin" name="login" value="Log in">
+</form>
+"""
+OPTIONS_PAGE = """
+<form action="/idp/enter/option" method="post">
+  <label><input type="radio" id="optionSms" name="option" value="sms" checked> Text to ***-***-1234</label>
+  <input type="radio" id="optionEmail" name="option" value="email"><label for="optionEmail">{label}</label>
+  <input type="submit" id="buttonContinue" name="continue" value="Continue">
+</form>
+"""
+CODE_PAGE = """
+<form action="/idp/verify" method="post">
+  <input type="text" id="code" name="code">
+  <input type="submit" id="buttonVerifyIdentity" name="verify" value="Verify">
+</form>
+"""
+SAML_RESPONSE_PAGE = """
+<form action="/saml/acs" method="post"><input type="hidden" name="SAMLResponse" value="response"></form>
+"""
+
+
+class FakeMailboxProvider(TwoFactorProvider):
+    """
+    A local mailbox the stand-in login server delivers the 2FA code to.
+    """
+
+    def __init__(self):
+        self.code: str | None = None
+        self.received_at: datetime | None = None
+
+    def authenticate(self, address: str) -> bool:
+        return True
+
+    def get_code(self, address: str, received_after: datetime | None = None) -> str | None:
+        if self.code is None or (received_after is not None and self.received_at <= received_after):
+            return None
+        return self.code
+
+
+class LoginHandler(BaseHTTPRequestHandler):
+    """
+    Serve the login pages, checking every submitted form like the real login pages would.
+    """
+
+    def do_GET(self):
+        if self.path == "/login":
+            self.__page(LOGIN_PAGE)
+        elif self.path == "/SAML2/Unsolicited/SSO":
+            self.__page(PASSWORD_PAGE)
+        elif self.path == "/idp/enter":
+            self.__page(OPTIONS_PAGE.format(label=self.server.offered_label))
+        elif self.path == "/shifts":
+            self.__page("<h1>Shifts</h1>")
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        data = {name: values[0] for name, values in
+                parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode(), keep_blank_values=True).items()}
+        self.server.submitted.append((self.path, data))
+        if self.path == "/associate" and data == {"login": "user", "csrf": "login-token", "action": "login"}:
+            self.__page(SAML_REQUEST_PAGE)
+        elif self.path == "/saml" and data == {"SAMLRequest": "request"}:
+            self.__redirect("/SAML2/Unsolicited/SSO")
+        elif self.path == "/SAML2/Unsolicited/SSO" and data == {"password": "password", "login": "Log in"}:
+            self.__redirect("/idp/enter")
+        elif self.path == "/idp/enter/option" and data == {"option": "email", "continue": "Continue"}:
+            self.server.mailbox.code = CODE
+            self.server.mailbox.received_at = datetime.now(timezone.utc)
+            self.__page(CODE_PAGE)
+        elif self.path == "/idp/verify" and data == {"code": CODE, "verify": "Verify"}:
+            self.__page(SAML_RESPONSE_PAGE)
+        elif self.path == "/saml/acs":
+            self.__redirect("/shifts", self.server.cookies)
+        else:
+            self.send_error(403)
+
+    def __page(self, html: str) -> None:
+        body = html.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __redirect(self, location: str, cookies: tuple[str, ...] = ()) -> None:
+        self.send_response(302)
+        self.send_header("Location", location)
+        for name in cookies:
+            self.send_header("Set-Cookie", f"{name}={name}-value; Path=/")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpLoginTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.mailbox = FakeMailboxProvider()
+        providers = getattr(provider_module, "__providers")
+        self.previous_provider = providers.get(TwoFAMethod.OUTLOOK)
+        register_provider(TwoFAMethod.OUTLOOK, self.mailbox)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), LoginHandler)
+        self.server.mailbox = self.mailbox
+        self.server.submitted = []
+        self.server.offered_label = obfuscate_2fa_method(ADDRESS, TwoFAMethod.OUTLOOK)
+        self.server.cookies = ("atoz-oauth-token", "atoz-refresh-token", "atoz-auth-session")
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/login"
+        self.config = UserConfig("user", "password", (TwoFAMethod.OUTLOOK, ADDRESS),
+                                 PickShiftApiConfig(None, timezone.utc, []), None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        providers = getattr(provider_module, "__providers")
+        if self.previous_provider is None:
+            providers.pop(TwoFAMethod.OUTLOOK, None)
+        else:
+            providers[TwoFAMethod.OUTLOOK] = self.previous_provider
+
+    async def test_login_collects_cookies(self):
+        cookies = await HttpLogin(self.config, self.url).login()
+
+        self.assertEqual({cookie["name"]: cookie["value"] for cookie in cookies},
+                         {name: f"{name}-value" for name in self.server.cookies})
+        # Both self-submitting SAML pages were followed
+        self.assertEqual([path for path, _ in self.server.submitted],
+                         ["/associate", "/saml", "/SAML2/Unsolicited/SSO", "/idp/enter/option", "/idp/verify",
+                          "/saml/acs"])
+
+    async def test_missing_2fa_option_raises(self):
+        self.server.offered_label = "o*******@example.com"
+
+        with self.assertRaisesRegex(RuntimeError, "not offered"):
+            await HttpLogin(self.config, self.url).login()
+
+    async def test_wrong_password_raises(self):
+        self.config.password = "wrong"
+
+        with self.assertRaisesRegex(RuntimeError, "403"):
+            await HttpLogin(self.config, self.url).login()
+
+    async def test_missing_cookie_raises(self):
+        self.server.cookies = ("atoz-oauth-token",)
+
+        with self.assertRaisesRegex(RuntimeError, "atoz-refresh-token, atoz-auth-session"):
+            await HttpLogin(self.config, self.url).login()
+
+
+class ParseFormsTest(unittest.TestCase):
+
+    def test_labels_and_submitted_data(self):
+        form, = parse_forms(OPTIONS_PAGE.format(label="u***@example.com"))
+
+        self.assertEqual(form.labels, {"optionSms": "Text to ***-***-1234", "optionEmail": "u***@example.com"})
+        # The checked option is sent unless another one of the same name is chosen
+        self.assertEqual(form.get_data(), {"option": "sms"})
+        self.assertEqual(form.get_data({"optionEmail": ""}, "buttonContinue"),
+                         {"option": "email", "continue": "Continue"})
+        self.assertFalse(form.is_auto_submit())
+
+    def test_hidden_only_form_is_auto_submit(self):
+        form, = parse_forms(SAML_RESPONSE_PAGE)
+
+        self.assertTrue(form.is_auto_submit())
+        self.assertEqual(form.get_data(), {"SAMLResponse": "response"})
+
+
+if __name__ == "__main__":
+    unittest.main()
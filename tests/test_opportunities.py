@@ -0,0 +1,30 @@
+import unittest
+
+from api.opportunities import OpportunityCache, OpportunityState, PickOutcome
+
+
+class OpportunityCacheTest(unittest.TestCase):
+
+    def test_only_due_retries_are_pending(self):
+        cache = OpportunityCache(ttl=600, retry_after=3)
+        cache.record("o1", PickOutcome(OpportunityState.RETRY, "HTTP 502"), now=100)
+
+        self.assertFalse(cache.has_pending_retries(101))
+        self.assertTrue(cache.has_pending_retries(103))
+
+    def test_unlisted_retries_are_dropped(self):
+        cache = OpportunityCache(ttl=600, retry_after=3)
+        cache.record("o1", PickOutcome(OpportunityState.RETRY, "HTTP 502"), now=100)
+        cache.record("o2", PickOutcome(OpportunityState.RETRY, "HTTP 502"), now=100)
+        cache.record("o3", PickOutcome(OpportunityState.PICKED), now=100)
+
+        cache.drop_unlisted_retries({"o2"})
+
+        self.assertIsNone(cache.get("o1", 103))
+        self.assertEqual(cache.get("o2", 103).state, OpportunityState.RETRY)
+        self.assertEqual(cache.get("o3", 103).state, OpportunityState.PICKED)
+        self.assertTrue(cache.has_pending_retries(103))
+
+
+if __name__ == "__main__":
+    unittest.main()
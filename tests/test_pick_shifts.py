@@ -0,0 +1,254 @@
+import json
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+import api.pick_shifts as pick_shifts
+from api.opportunities import OpportunityState, create_opportunity_cache
+from app.models import UserConfig, PickShiftApiConfig, ShiftBlockConfig, TwoFAMethod
+
+pick_shift = getattr(pick_shifts, "__pick_shift")
+pick_shifts_batched = getattr(pick_shifts, "__pick_shifts")
+
+
+def build_shift(shift_id: str, start: datetime, hours: float = 1) -> dict:
+    return {
+        "id": shift_id,
+        "eligibility": {"isEligible": True},
+        "unavailability": [],
+        "skill": None,
+        "shift": {"timeRange": {"start": start.isoformat(), "end": (start + timedelta(hours=hours)).isoformat()}}
+    }
+
+
+class FakeResponse:
+    def __init__(self, body, status_code: int = 200):
+        self.__body = body
+        self.status_code = status_code
+        self.text = body if isinstance(body, str) else json.dumps(body)
+
+    def json(self):
+        if isinstance(self.__body, str):
+            raise ValueError("Expecting value")
+        return self.__body
+
+
+class FakeClient:
+    """
+    Answer each GraphQL operation with the handler registered for it, recording the requests.
+    """
+
+    def __init__(self, handlers: dict):
+        self.handlers = handlers
+        self.requests = []
+
+    async def post(self, url, headers=None, json=None, timeout=None):
+        self.requests.append(json)
+        response = self.handlers[json["operationName"]](json)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class FakeSession:
+    def __init__(self, config: UserConfig, client: FakeClient):
+        self.config = config
+        self.__client = client
+        self.__opportunities = create_opportunity_cache()
+
+    def get_config(self) -> UserConfig:
+        return self.config
+
+    def get_opportunities(self):
+        return self.__opportunities
+
+    def get_client(self) -> FakeClient:
+        return self.__client
+
+    async def get_employee_id(self) -> int:
+        return 1
+
+
+def create_config(days: int = 1) -> UserConfig:
+    start = (datetime.now(timezone.utc) + timedelta(days=1)).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    # Rules two days apart are discovered in separate windows
+    rules = [ShiftBlockConfig(start + timedelta(days=2 * i), start + timedelta(days=2 * i, hours=8))
+             for i in range(days)]
+    return UserConfig("user", "password", (TwoFAMethod.OUTLOOK, "user@example.com"),
+                      PickShiftApiConfig(None, timezone.utc, rules), None)
+
+
+# A failed AddShift is answered with HTTP 200, `data: null` and the errors
+REJECTED_PICK = {"data": None, "errors": [{"message": "Shift is no longer available", "path": ["addShift"]}]}
+
+
+class PickShiftTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_pick_rejected_with_null_data(self):
+        config = create_config()
+        client = FakeClient({"AddShift": lambda data: FakeResponse(REJECTED_PICK)})
+        shift = build_shift("o1", datetime.now(timezone.utc) + timedelta(days=1))
+
+        outcome = await pick_shift(FakeSession(config, client), "url", shift)
+
+        self.assertEqual(outcome.state, OpportunityState.REJECTED)
+        self.assertEqual(outcome.reason, "Shift is no longer available")
+
+    async def test_pick_rejected_with_invalid_body(self):
+        config = create_config()
+        client = FakeClient({"AddShift": lambda data: FakeResponse("<html>")})
+        shift = build_shift("o1", datetime.now(timezone.utc) + timedelta(days=1))
+
+        outcome = await pick_shift(FakeSession(config, client), "url", shift)
+
+        self.assertEqual(outcome.state, OpportunityState.REJECTED)
+
+    async def test_run_releases_time_block_of_rejected_pick(self):
+        config = create_config()
+        rule = config.pick_shift_api_config.rules[0]
+        shift = build_shift("o1", rule.start.replace(tzinfo=timezone.utc) + timedelta(hours=1))
+        opportunities = {"opportunities": [shift], "counts": [{"count": 1}]}
+        client = FakeClient({
+            "FindShiftsCounts": lambda data: FakeResponse({"data": {"w0": {"counts": [{"count": 1}]}}}),
+            "FindShiftsPage": lambda data: FakeResponse({"data": {"shiftOpportunities": opportunities}}),
+            "AddShift": lambda data: FakeResponse(REJECTED_PICK),
+        })
+
+        session = FakeSession(config, client)
+
+        await pick_shifts.run(session)
+
+        now = time.time()
+        entry = session.get_opportunities().get("o1", now)
+        self.assertEqual(entry.state, OpportunityState.REJECTED)
+        self.assertEqual(session.get_opportunities().get_committed_blocks(now), [])
+
+    async def test_run_survives_discovery_timeout(self):
+        config = create_config()
+        timeout = httpx.ConnectTimeout("timed out")
+        client = FakeClient({"FindShiftsCounts": lambda data: timeout, "FindShiftsPage": lambda data: timeout})
+
+        session = FakeSession(config, client)
+
+        plan = await pick_shifts.run(session)
+
+        self.assertIsNotNone(plan)
+        self.assertEqual(len(session.get_opportunities()), 0)
+
+    async def test_discovery_failure_does_not_cancel_picks(self):
+        config = create_config(days=2)
+        first, _ = [rule.start.replace(tzinfo=timezone.utc) for rule in config.pick_shift_api_config.rules]
+        # The opportunity of the second window is malformed, filtering it fails after the first pick was sent
+        windows = {
+            "w0": {"opportunities": [build_shift("o1", first)], "counts": [{"count": 1}]},
+            "w1": {"opportunities": [{"id": "o2"}], "counts": [{"count": 1}]},
+        }
+        client = FakeClient({
+            "FindShiftsCounts": lambda data: FakeResponse({"data": {"w0": {"counts": [{"count": 1}]},
+                                                                    "w1": {"counts": [{"count": 1}]}}}),
+            "FindShiftsPage": lambda data: FakeResponse({"data": windows}),
+            "AddShift": lambda data: FakeResponse({"data": {"addShift": "o1"}}),
+        })
+
+        session = FakeSession(config, client)
+
+        await pick_shifts.run(session)
+
+        self.assertEqual(session.get_opportunities().get("o1", time.time()).state, OpportunityState.PICKED)
+
+    async def test_probe_waits_for_window_counts(self):
+        config = create_config()
+        rule = config.pick_shift_api_config.rules[0]
+        shift = build_shift("o1", rule.start.replace(tzinfo=timezone.utc) + timedelta(hours=1))
+        opportunities = {"opportunities": [shift], "counts": [{"count": 1}]}
+        client = FakeClient({
+            "FindShiftsCounts": lambda data: FakeResponse({"data": {"w0": {"counts": [{"count": 1}]}}}),
+            "FindShiftsPage": lambda data: FakeResponse({"data": {"shiftOpportunities": opportunities}}),
+            "AddShift": lambda data: FakeResponse({"data": {"addShift": "o1"}}),
+        })
+        session = FakeSession(config, client)
+
+        plan = await pick_shifts.run(session)
+
+        # The first cycle has no count to compare a probe with
+        self.assertEqual([request["operationName"] for request in client.requests], ["FindShiftsPage", "AddShift"])
+        self.assertEqual(plan.window_counts, {0: 1})
+
+        client.requests.clear()
+        await pick_shifts.run(session, plan)
+
+        # The count did not change, the full list is not fetched again
+        self.assertEqual([request["operationName"] for request in client.requests], ["FindShiftsCounts"])
+
+        client.requests.clear()
+        plan.last_full_fetch -= 60
+        await pick_shifts.run(session, plan)
+
+        # Every window is fetched in full once in a while, the probe misses a swap at the same count
+        self.assertEqual([request["operationName"] for request in client.requests], ["FindShiftsPage"])
+
+    async def test_batched_pick_with_null_data(self):
+        config = create_config()
+        start = config.pick_shift_api_config.rules[0].start.replace(tzinfo=timezone.utc)
+        shifts = [build_shift("o1", start), build_shift("o2", start + timedelta(hours=2))]
+        client = FakeClient({"AddShift": lambda data: FakeResponse({"data": None, "errors": [
+            {"message": "Shift is no longer available", "path": ["s0"]},
+            {"message": "Shift overlaps another shift", "path": ["s1"]},
+        ]})})
+        session = FakeSession(config, client)
+        plan = await pick_shifts.prepare(session)
+
+        results = await pick_shifts_batched(session, plan, shifts)
+
+        # The mutations ran, their errors settle each pick without sending them again
+        self.assertEqual(len(client.requests), 1)
+        self.assertEqual(results["o1"].state, OpportunityState.REJECTED)
+        self.assertEqual(results["o1"].reason, "Shift is no longer available")
+        self.assertEqual(results["o2"].reason, "Shift overlaps another shift")
+        self.assertTrue(plan.batch_picks)
+
+    async def test_batched_pick_server_error_keeps_batching(self):
+        config = create_config()
+        start = config.pick_shift_api_config.rules[0].start.replace(tzinfo=timezone.utc)
+        shifts = [build_shift("o1", start), build_shift("o2", start + timedelta(hours=2))]
+
+        def add_shift(data):
+            if len(data["variables"]) > 1:
+                return FakeResponse("Bad Gateway", 502)
+            return FakeResponse({"data": {"addShift": data["variables"]["shiftOpportunityId"]["shiftOpportunityId"]}})
+
+        session = FakeSession(config, FakeClient({"AddShift": add_shift}))
+        plan = await pick_shifts.prepare(session)
+
+        results = await pick_shifts_batched(session, plan, shifts)
+
+        # The shifts fall back to one request each, the next cycle batches again
+        self.assertEqual({shift_id: outcome.state for shift_id, outcome in results.items()},
+                         {"o1": OpportunityState.PICKED, "o2": OpportunityState.PICKED})
+        self.assertTrue(plan.batch_picks)
+
+    async def test_config_change_keeps_picked_shifts(self):
+        config = create_config()
+        rule = config.pick_shift_api_config.rules[0]
+        shift = build_shift("o1", rule.start.replace(tzinfo=timezone.utc) + timedelta(hours=1))
+        opportunities = {"opportunities": [shift], "counts": [{"count": 1}]}
+        client = FakeClient({
+            "FindShiftsPage": lambda data: FakeResponse({"data": {"shiftOpportunities": opportunities}}),
+            "AddShift": lambda data: FakeResponse({"data": {"addShift": "o1"}}),
+        })
+        session = FakeSession(config, client)
+        plan = await pick_shifts.run(session)
+
+        # An edited config, e.g. a new priority, rebuilds the plan
+        session.config = create_config()
+        client.requests.clear()
+        await pick_shifts.run(session, plan)
+
+        # The shift picked before the edit is not sent again
+        self.assertNotIn("AddShift", [request["operationName"] for request in client.requests])
+
+
+if __name__ == "__main__":
+    unittest.main()
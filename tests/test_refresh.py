@@ -0,0 +1,40 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from app.refresh import SessionRefresher, RefreshSettings
+from utils.scheduler import DeadlineScheduler
+
+
+class BrokenCookieSession:
+    """
+    A session whose expiration cookie cannot be parsed.
+    """
+
+    def __init__(self):
+        self.reads = 0
+
+    def get_config(self):
+        return SimpleNamespace(username="user")
+
+    def get_session_expiration(self):
+        self.reads += 1
+        raise ValueError("bad cookie")
+
+
+class SessionRefresherTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_error_does_not_stop_refresher(self):
+        session = BrokenCookieSession()
+        refresher = SessionRefresher(session, DeadlineScheduler(), RefreshSettings(600, 0, 60, 0.01, 2, 60))
+
+        refresher.start()
+        await asyncio.sleep(0.1)
+        await refresher.stop()
+
+        # The loop kept going after the first error, and stopping it does not raise
+        self.assertGreater(session.reads, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from utils.scheduler import DeadlineScheduler
+
+
+class DeadlineSchedulerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_sleep_reaches_deadline(self):
+        scheduler = DeadlineScheduler()
+        deadline = time.time() + 0.05
+
+        reached = await scheduler.sleep_until("a", deadline)
+
+        self.assertTrue(reached)
+        self.assertGreaterEqual(time.time(), deadline)
+
+    async def test_past_deadline_returns_immediately(self):
+        scheduler = DeadlineScheduler()
+
+        self.assertTrue(await scheduler.sleep_until("a", time.time() - 1))
+
+    async def test_waiters_wake_in_deadline_order(self):
+        scheduler = DeadlineScheduler()
+        woken = []
+
+        async def sleep(key: str, delay: float):
+            await scheduler.sleep_until(key, time.time() + delay)
+            woken.append(key)
+
+        await asyncio.gather(sleep("late", 0.1), sleep("early", 0.02), sleep("middle", 0.05))
+
+        self.assertEqual(woken, ["early", "middle", "late"])
+
+    async def test_wake_ends_sleep_early(self):
+        scheduler = DeadlineScheduler()
+        task = asyncio.create_task(scheduler.sleep_until("a", time.time() + 60))
+        await asyncio.sleep(0)
+
+        scheduler.wake("a")
+
+        self.assertFalse(await asyncio.wait_for(task, 1))
+
+    async def test_wake_from_another_thread(self):
+        scheduler = DeadlineScheduler()
+        task = asyncio.create_task(scheduler.sleep_until("a", time.time() + 60))
+        await asyncio.sleep(0)
+
+        threading.Thread(target=scheduler.wake, args=("a",)).start()
+
+        self.assertFalse(await asyncio.wait_for(task, 1))
+
+    async def test_new_wait_replaces_previous_one(self):
+        scheduler = DeadlineScheduler()
+        first = asyncio.create_task(scheduler.sleep_until("a", time.time() + 60))
+        await asyncio.sleep(0)
+
+        reached = await scheduler.sleep_until("a", time.time() + 0.02)
+
+        self.assertTrue(reached)
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+
+if __name__ == "__main__":
+    unittest.main()
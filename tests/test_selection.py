@@ -0,0 +1,51 @@
+import unittest
+from typing import Optional
+
+from api.selection import Candidate, select_non_overlapping
+
+
+def candidate(shift_id: str, start: float, end: float, value: Optional[float] = None) -> Candidate:
+    return Candidate({"id": shift_id}, start, end, end - start if value is None else value)
+
+
+def selected_ids(selected: list[Candidate]) -> list[str]:
+    return [selected_candidate.shift["id"] for selected_candidate in selected]
+
+
+class SelectNonOverlappingTest(unittest.TestCase):
+
+    def test_keeps_compatible_candidates_in_end_order(self):
+        candidates = [candidate("b", 20, 30), candidate("a", 0, 10), candidate("c", 10, 20)]
+
+        # Touching candidates do not overlap
+        self.assertEqual(selected_ids(select_non_overlapping(candidates, [])), ["a", "c", "b"])
+
+    def test_prefers_highest_total_value(self):
+        # One long candidate is worth less than the two short ones it overlaps
+        candidates = [candidate("long", 0, 30, 5), candidate("first", 0, 10, 3), candidate("second", 20, 30, 3)]
+
+        self.assertEqual(selected_ids(select_non_overlapping(candidates, [])), ["first", "second"])
+
+    def test_prefers_single_candidate_worth_more(self):
+        candidates = [candidate("long", 0, 30, 7), candidate("first", 0, 10, 3), candidate("second", 20, 30, 3)]
+
+        self.assertEqual(selected_ids(select_non_overlapping(candidates, [])), ["long"])
+
+    def test_skips_candidates_overlapping_blocked_time(self):
+        candidates = [candidate("a", 0, 10), candidate("b", 10, 20), candidate("c", 25, 35), candidate("d", 40, 50)]
+        # Overlapping blocked time blocks are merged, `c` falls within the merged block
+        blocked = [(15, 30), (12, 22)]
+
+        self.assertEqual(selected_ids(select_non_overlapping(candidates, blocked)), ["a", "d"])
+
+    def test_skips_worthless_candidates(self):
+        candidates = [candidate("a", 0, 10, 0), candidate("b", 20, 30)]
+
+        self.assertEqual(selected_ids(select_non_overlapping(candidates, [])), ["b"])
+
+    def test_no_candidates(self):
+        self.assertEqual(select_non_overlapping([], [(0, 10)]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from utils.time import plan_windows
+
+HOUR = 3600
+
+
+class PlanWindowsTest(unittest.TestCase):
+
+    def test_drops_past_intervals_and_clips_current_one(self):
+        intervals = [(0, 10), (20, 40)]
+
+        self.assertEqual(plan_windows(intervals, 30, HOUR, HOUR, 1), [(30, 40)])
+
+    def test_merges_intervals_within_merge_gap(self):
+        intervals = [(0, 10), (15, 20), (50, 60)]
+
+        self.assertEqual(plan_windows(intervals, 0, HOUR, HOUR, 1, merge_gap=5), [(0, 20), (50, 60)])
+
+    def test_does_not_merge_past_max_window(self):
+        intervals = [(0, 40), (45, 70)]
+
+        self.assertEqual(plan_windows(intervals, 0, 60, 60, 1, merge_gap=10), [(0, 40), (45, 70)])
+
+    def test_splits_intervals_longer_than_max_window(self):
+        self.assertEqual(plan_windows([(0, 250)], 0, 100, 100, 1), [(0, 100), (100, 200), (200, 250)])
+
+    def test_splits_longest_window_for_parallelism(self):
+        windows = plan_windows([(0, 8 * HOUR), (10 * HOUR, 11 * HOUR)], 0, 24 * HOUR, HOUR, 3)
+
+        self.assertEqual(windows, [(0, 4 * HOUR), (4 * HOUR, 8 * HOUR), (10 * HOUR, 11 * HOUR)])
+
+    def test_does_not_split_below_min_window(self):
+        windows = plan_windows([(0, 3 * HOUR)], 0, 24 * HOUR, 2 * HOUR, 4)
+
+        self.assertEqual(windows, [(0, 3 * HOUR)])
+
+    def test_no_intervals(self):
+        self.assertEqual(plan_windows([], 0, HOUR, HOUR, 4), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import asyncio
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from two_factor.provider import TwoFactorProvider
+from two_factor.waiter import wait_for_2fa_code, wait_for_2fa_code_async
+
+
+class FakeMailboxProvider(TwoFactorProvider):
+    """
+    A local mailbox holding (received at, code) messages, answering like the Outlook provider.
+    """
+
+    def __init__(self):
+        self.messages: list[tuple[datetime, str]] = []
+        self.polls = 0
+
+    def deliver(self, code: str, received_at: datetime | None = None) -> None:
+        self.messages.append((received_at or datetime.now(timezone.utc), code))
+
+    def authenticate(self, address: str) -> bool:
+        return True
+
+    def get_code(self, address: str, received_after: datetime | None = None) -> str | None:
+        self.polls += 1
+        received = [message for message in self.messages if received_after is None or message[0] > received_after]
+        return max(received)[1] if received else None
+
+
+class WaitForCodeTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_fresh_code_returns_immediately(self):
+        provider = FakeMailboxProvider()
+        requested_at = datetime.now(timezone.utc)
+        provider.deliver("123456")
+
+        started = time.monotonic()
+        code = await provider.wait_for_code_async("user@example.com", requested_at)
+
+        self.assertEqual(code, "123456")
+        self.assertEqual(provider.polls, 1)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    async def test_stale_code_is_ignored(self):
+        provider = FakeMailboxProvider()
+        requested_at = datetime.now(timezone.utc)
+        # A code of a previous login, older than the allowed clock skew
+        provider.deliver("111111", requested_at - timedelta(minutes=5))
+
+        async def deliver_later():
+            await asyncio.sleep(0.1)
+            provider.deliver("222222")
+
+        delivery = asyncio.create_task(deliver_later())
+        code = await wait_for_2fa_code_async(
+            lambda received_after: provider.get_code_async("user@example.com", received_after), requested_at,
+            timeout=2, initial_interval=0.05, max_interval=0.05)
+        await delivery
+
+        self.assertEqual(code, "222222")
+        self.assertGreater(provider.polls, 1)
+
+    async def test_timeout_raises(self):
+        provider = FakeMailboxProvider()
+        requested_at = datetime.now(timezone.utc)
+        provider.deliver("111111", requested_at - timedelta(minutes=5))
+
+        with self.assertRaises(TimeoutError):
+            await wait_for_2fa_code_async(
+                lambda received_after: provider.get_code_async("user@example.com", received_after), requested_at,
+                timeout=0.2, initial_interval=0.05, max_interval=0.05)
+
+
+class WaitForCodeBlockingTest(unittest.TestCase):
+
+    def test_blocking_wait_returns_code(self):
+        provider = FakeMailboxProvider()
+        requested_at = datetime.now(timezone.utc)
+        provider.deliver("123456")
+
+        code = wait_for_2fa_code(lambda received_after: provider.get_code("user@example.com", received_after),
+                                 requested_at, timeout=1)
+
+        self.assertEqual(code, "123456")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,53 +1,137 @@
+import logging
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 from O365 import Account, FileSystemTokenBackend
 
-__active_accounts: dict[str, Account] = {}
-__FOLDER_NAME = os.getenv("O365_FOLDER_NAME", "AtoZ")
+from two_factor.provider import TwoFactorProvider
 
-def authenticate(username: str) -> bool:
+FOLDER_NAME = os.getenv("O365_FOLDER_NAME", "AtoZ")
+TOKEN_PATH = "O365_tokens"
+# Messages come newest first, a few are enough to skip unrelated mail that arrived in between
+MESSAGE_LIMIT = 5
+CODE_SUBJECT = "Amazon A to Z login verification code"
+CODE_PATTERN = re.compile(r'\d{6}')
+# A single writer keeps token writes for the same file ordered
+TOKEN_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="o365-token-writer")
+
+
+class CachedTokenBackend(FileSystemTokenBackend):
     """
-    Authenticate the user with the given username.
+    File token backend that reads the token file once and writes it behind the caller.
 
-    :param username: The username to authenticate.
-    :return: True if authentication is successful, False otherwise.
+    The token lives in memory after the first load. Saves only mark it dirty and queue one write on a
+    background thread, so refreshing a token never blocks a login on disk I/O.
     """
-    __client_id = os.getenv("O365_CLIENT_ID")
-    __client_secret = os.getenv("O365_CLIENT_SECRET")
 
-    if username in __active_accounts:
-        account = __active_accounts[username]
+    def __init__(self, *args, writer: ThreadPoolExecutor, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__writer = writer
+        self.__lock = threading.Lock()
+        self.__loaded = False
+        self.__load_result = None
+        self.__dirty = False
+
+    def load_token(self, *args, **kwargs):
+        with self.__lock:
+            if not self.__loaded:
+                self.__load_result = super().load_token(*args, **kwargs)
+                self.__loaded = True
+            return self.__load_result
+
+    def save_token(self, *args, **kwargs):
+        with self.__lock:
+            queue_write = not self.__dirty
+            self.__dirty = True
+        if queue_write:
+            self.__writer.submit(self.__write, args, kwargs)
+        return True
+
+    def __write(self, args: tuple, kwargs: dict) -> None:
+        with self.__lock:
+            if not self.__dirty:
+                return
+            self.__dirty = False
+        try:
+            super().save_token(*args, **kwargs)
+        except Exception as e:
+            logging.error(f"Failed to write O365 token: {e}")
+
+
+class OutlookProvider(TwoFactorProvider):
+    """
+    2FA codes read from an Outlook mailbox folder through O365.
+    Accounts, their tokens and the resolved folders are cached per address.
+    """
+
+    def __init__(self, folder_name: str = FOLDER_NAME, token_path: str = TOKEN_PATH,
+                 token_writer: ThreadPoolExecutor = TOKEN_WRITER):
+        self.__folder_name = folder_name
+        self.__token_path = token_path
+        self.__token_writer = token_writer
+        self.__lock = threading.Lock()
+        self.__accounts: dict[str, Account] = {}
+        self.__folders: dict[str, object] = {}
+
+    def authenticate(self, address: str) -> bool:
+        """
+        Authenticate the user with the given username.
+
+        :param address: The username to authenticate.
+        :return: True if authentication is successful, False otherwise.
+        """
+        account = self.__get_account(address)
         if account.is_authenticated:
             return True
-    else:
+        # Authenticate the account
+        return bool(account.authenticate(scopes=['basic', 'mailbox']))
 
-        account = Account((__client_id, __client_secret), username=username, token_backend=FileSystemTokenBackend(token_path="O365_tokens", token_filename=f"{username}.token"))
-        __active_accounts[username] = account
+    def get_code(self, address: str, received_after: datetime | None = None) -> str | None:
+        """
+        Get the 2FA code for the given username.
+
+        :param address: The username to get the 2FA code for.
+        :param received_after: Only accept codes from messages received after this time.
+        :return: The 2FA code, or None if no matching message was found.
+        """
+        account = self.__get_account(address)
         if not account.is_authenticated:
-            # Authenticate the account
-            if not account.authenticate(scopes=['basic', 'mailbox']):
-                return False
-            __active_accounts[username] = account
-    return True
+            raise ValueError(f"Account for {address} is not authenticated")
+        try:
+            messages = list(self.__get_folder(address, account).get_messages(limit=MESSAGE_LIMIT))
+        except Exception:
+            # The cached folder may have been deleted or recreated, resolve it again once
+            self.__folders.pop(address, None)
+            messages = list(self.__get_folder(address, account).get_messages(limit=MESSAGE_LIMIT))
+        for message in messages:
+            if received_after is not None and message.received is not None and message.received < received_after:
+                break
+            if CODE_SUBJECT in message.subject:
+                match = CODE_PATTERN.search(message.body)
+                if match is not None:
+                    return match.group()
+        return None
 
-def get_2fa_code(username: str) -> str or None:
-    """
-    Get the 2FA code for the given username.
+    def __get_account(self, address: str) -> Account:
+        with self.__lock:
+            if address not in self.__accounts:
+                client_id = os.getenv("O365_CLIENT_ID")
+                client_secret = os.getenv("O365_CLIENT_SECRET")
+                token_backend = CachedTokenBackend(token_path=self.__token_path, token_filename=f"{address}.token",
+                                                   writer=self.__token_writer)
+                self.__accounts[address] = Account((client_id, client_secret), username=address,
+                                                   token_backend=token_backend)
+            return self.__accounts[address]
 
-    :param username: The username to get the 2FA code for.
-    :return: The 2FA code.
-    """
-    account = __active_accounts[username]
-    if account is None:
-        raise ValueError(f"Account for {username} not found")
-    if not account.is_authenticated:
-        raise ValueError(f"Account for {username} is not authenticated")
-    # Get the 2FA code from the account
-    mailbox = account.mailbox()
-    folder = mailbox.get_folder(folder_name=__FOLDER_NAME)
-    for message in folder.get_messages(limit=1):
-        if "Amazon A to Z login verification code" in message.subject:
-            return re.search(r'\d{6}', message.body).group()
-    return None
+    def __get_folder(self, address: str, account: Account):
+        folder = self.__folders.get(address)
+        if folder is None:
+            folder = account.mailbox().get_folder(folder_name=self.__folder_name)
+            if folder is None:
+                raise ValueError(f"Folder {self.__folder_name} not found for {address}")
+            self.__folders[address] = folder
+        return folder
 
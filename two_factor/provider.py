@@ -0,0 +1,93 @@
+import asyncio
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from app.models import TwoFAMethod
+from two_factor.waiter import wait_for_2fa_code_async
+
+__workers = int(os.getenv("TWO_FACTOR_WORKERS", "8"))
+__executor = ThreadPoolExecutor(max_workers=__workers, thread_name_prefix="two-factor")
+__providers: dict[TwoFAMethod, "TwoFactorProvider"] = {}
+
+
+class TwoFactorProvider(ABC):
+    """
+    Source of 2FA codes for one 2FA method.
+
+    Implementations provide the blocking `authenticate` and `get_code`, which login threads call directly.
+    Async callers use the `_async` variants, which run them on a bounded thread pool shared by all providers
+    so many concurrent logins neither block the event loop nor queue behind each other.
+    """
+
+    @abstractmethod
+    def authenticate(self, address: str) -> bool:
+        """
+        Make sure the mailbox of the given address can be read.
+
+        :param address: The address the codes are sent to.
+        :return: True if the mailbox is ready, False otherwise.
+        """
+
+    @abstractmethod
+    def get_code(self, address: str, received_after: datetime | None = None) -> str | None:
+        """
+        Get the newest 2FA code sent to the given address.
+
+        :param address: The address the codes are sent to.
+        :param received_after: Only accept codes received after this time.
+        :return: The 2FA code, or None if there is none yet.
+        """
+
+    async def authenticate_async(self, address: str) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), self.authenticate, address)
+
+    async def get_code_async(self, address: str, received_after: datetime | None = None) -> str | None:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), self.get_code, address,
+                                                                received_after)
+
+    async def wait_for_code_async(self, address: str, requested_at: datetime) -> str:
+        """
+        Wait for the code requested at the given time without blocking the event loop.
+
+        :param address: The address the code is sent to.
+        :param requested_at: The time the code was requested at.
+        :return: The 2FA code.
+        """
+        return await wait_for_2fa_code_async(lambda received_after: self.get_code_async(address, received_after),
+                                             requested_at)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Get the thread pool the async provider calls run on.
+    """
+    return __executor
+
+
+def register_provider(method: TwoFAMethod, provider: TwoFactorProvider) -> None:
+    """
+    Register the provider used for a 2FA method, replacing the current one.
+    Tests and benchmarks use it to plug in a local stand-in mailbox.
+
+    :param method: The 2FA method.
+    :param provider: The provider to use.
+    """
+    __providers[method] = provider
+
+
+def get_provider(method: TwoFAMethod) -> TwoFactorProvider:
+    """
+    Get the provider for a 2FA method.
+
+    :param method: The 2FA method.
+    :return: The registered provider.
+    """
+    if method not in __providers and method == TwoFAMethod.OUTLOOK:
+        # Imported lazily so a stand-in provider can be registered without O365 installed
+        from two_factor.outlook import OutlookProvider
+        __providers[method] = OutlookProvider()
+    if method not in __providers:
+        raise ValueError(f"Unknown 2FA method type: {method}")
+    return __providers[method]
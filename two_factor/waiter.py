@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Awaitable
+
+__timeout = float(os.getenv("TWO_FACTOR_TIMEOUT", "90"))
+__initial_interval = float(os.getenv("TWO_FACTOR_POLL_INTERVAL", "1"))
+__max_interval = float(os.getenv("TWO_FACTOR_MAX_POLL_INTERVAL", "5"))
+__max_clock_skew = timedelta(seconds=float(os.getenv("TWO_FACTOR_MAX_CLOCK_SKEW", "5")))
+
+
+def wait_for_2fa_code(fetch_code: Callable[[datetime], str | None], requested_at: datetime,
+                      timeout: float | None = None, initial_interval: float | None = None,
+                      max_interval: float | None = None, backoff: float = 1.5) -> str:
+    """
+    Blocking variant of `wait_for_2fa_code_async` for login threads, which have no event loop of their own.
+    The fetch blocks the private loop it runs on, which nothing else shares.
+
+    :param fetch_code: Returns the newest code received after the given time, or None if there is none yet.
+    :param requested_at: The time the code was requested at. Older messages belong to a previous login.
+    :param timeout: The maximum time to wait for the code, in seconds.
+    :param initial_interval: The delay before the second poll, in seconds. The first poll is immediate.
+    :param max_interval: The maximum delay between two polls, in seconds.
+    :param backoff: The factor the delay grows by after every empty poll.
+    :return: The 2FA code.
+    """
+    async def fetch(received_after: datetime) -> str | None:
+        return fetch_code(received_after)
+
+    return asyncio.run(wait_for_2fa_code_async(fetch, requested_at, timeout, initial_interval, max_interval, backoff))
+
+
+async def wait_for_2fa_code_async(fetch_code: Callable[[datetime], Awaitable[str | None]], requested_at: datetime,
+                                  timeout: float | None = None, initial_interval: float | None = None,
+                                  max_interval: float | None = None, backoff: float = 1.5) -> str:
+    """
+    Poll the mailbox until a code sent after the given time arrives.
+
+    :param fetch_code: Returns the newest code received after the given time, or None if there is none yet.
+    :param requested_at: The time the code was requested at. Older messages belong to a previous login.
+    :param timeout: The maximum time to wait for the code, in seconds.
+    :param initial_interval: The delay before the second poll, in seconds. The first poll is immediate.
+    :param max_interval: The maximum delay between two polls, in seconds.
+    :param backoff: The factor the delay grows by after every empty poll.
+    :return: The 2FA code.
+    """
+    timeout = __timeout if timeout is None else timeout
+    interval = __initial_interval if initial_interval is None else initial_interval
+    max_interval = __max_interval if max_interval is None else max_interval
+    # The mail server stamps messages with its own clock, allow for a little drift
+    received_after = requested_at - __max_clock_skew
+    deadline = time.monotonic() + timeout
+    attempts = 0
+    while True:
+        attempts += 1
+        code = await fetch_code(received_after)
+        if code is not None:
+            logging.debug(f"Got 2FA code after {attempts} polls")
+            return code
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"No 2FA code received within {timeout:.0f}s")
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(max_interval, interval * backoff)
@@ -1,8 +1,8 @@
 import re
-import time
 import shutil
 import os
 
+from selenium.common.exceptions import WebDriverException, TimeoutException, StaleElementReferenceException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from selenium.webdriver.remote.webelement import WebElement
@@ -46,13 +46,61 @@ class ElementActions:
             raise RuntimeError(f"Element not found: {by}={value}")
         return ElementActions(found_element)
 
+# Profile preferences of the lean login mode: skip everything the login forms do not need
+LEAN_PREFERENCES = {
+    # Do not load images, web fonts or media
+    "permissions.default.image": 2,
+    "gfx.downloadable_fonts.enabled": False,
+    "browser.display.use_document_fonts": 0,
+    "media.autoplay.default": 5,
+    "media.peerconnection.enabled": False,
+    # No speculative or background network traffic
+    "network.prefetch-next": False,
+    "network.dns.disablePrefetch": True,
+    "network.http.speculative-parallel-limit": 0,
+    "browser.safebrowsing.malware.enabled": False,
+    "browser.safebrowsing.phishing.enabled": False,
+    "app.update.auto": False,
+    "toolkit.telemetry.enabled": False,
+    "datareporting.policy.dataSubmissionEnabled": False,
+    # Less memory per instance
+    "browser.cache.disk.enable": False,
+    "browser.sessionhistory.max_entries": 2,
+    "browser.sessionstore.resume_from_crash": False,
+    "dom.ipc.processCount": 1,
+}
+
+# Clears the cookies, storage and caches of every site, run in the privileged chrome context.
+# Answers the number of cookies left, which must be zero
+CLEAR_SITE_DATA_SCRIPT = """
+const done = arguments[arguments.length - 1];
+Services.clearData.deleteData(Ci.nsIClearDataService.CLEAR_ALL, () => done(Services.cookies.cookies.length));
+"""
+
+__poll_frequency = float(os.getenv("BROWSER_POLL_INTERVAL", "0.05"))
+
+
 class BrowserFirefox:
-    def __init__(self, options=None, headless=True):
+    def __init__(self, options=None, headless=True, lean=False, poll_frequency=None):
+        """
+        :param options: The Firefox options to start with.
+        :param headless: Run the browser without a window.
+        :param lean: Use the lean login mode: eager page loads and no images, fonts or media.
+        :param poll_frequency: How often waits check their condition, in seconds.
+        """
         self.__started = False
         self.gecko_driver_path = self._find_gecko_driver()
         self.options = options or FirefoxOptions()
         if headless:
             self.options.add_argument("--headless")
+        # Needed to clear the site data of every host in `reset`
+        self.options.add_argument("-remote-allow-system-access")
+        if lean:
+            # Return from navigation once the DOM is ready instead of waiting for every subresource
+            self.options.page_load_strategy = "eager"
+            for name, value in LEAN_PREFERENCES.items():
+                self.options.set_preference(name, value)
+        self.poll_frequency = poll_frequency or get_default_poll_frequency()
         self.driver = None
 
     def _find_gecko_driver(self):
@@ -106,36 +154,63 @@ class BrowserFirefox:
         if self.driver:
             self.driver.quit()
             self.driver = None
+        self.__started = False
 
+    def is_alive(self) -> bool:
+        """
+        Check if the browser and its driver still respond.
+        """
+        if not self.__started or not self.driver:
+            return False
+        try:
+            _ = self.driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    def get_process_id(self) -> int | None:
+        """
+        Get the process ID of the main Firefox process, if the driver reports it.
+        """
+        if not self.driver:
+            return None
+        return self.driver.capabilities.get("moz:processID")
+
+    def reset(self):
+        """
+        Clear the cookies, storage and caches of every site, including hosts only passed through on a redirect,
+        so the browser can be reused for another user as if its profile were fresh.
+        Raises if any cookie is left, the browser must then not be reused.
+        """
+        if not self.__started:
+            raise RuntimeError("Browser is not started.")
+        self.driver.get("about:blank")
+        # WebDriver only reaches the cookies of the current document, the chrome context reaches the whole profile
+        with self.driver.context(self.driver.CONTEXT_CHROME):
+            remaining = self.driver.execute_async_script(CLEAR_SITE_DATA_SCRIPT)
+        if remaining:
+            raise RuntimeError(f"{remaining} cookies left after clearing the browser.")
 
     def get_url(self, url, timeout=10):
         if not self.__started:
             raise RuntimeError("Browser is not started.")
         self.driver.get(url)
-        is_url = WebDriverWait(self.driver, timeout).until(lambda d: d.current_url == url)
-        while not is_url and timeout > 0:
-            time.sleep(0.1)
-            timeout -= 0.1
-
+        self.__wait(lambda d: d.current_url == url, timeout, f"URL not reached: {url}")
 
     def find_elements(self, by, value, timeout=10):
         if not self.__started:
             raise RuntimeError("Browser is not started.")
-        elements_found = WebDriverWait(self.driver, timeout).until(
-            lambda d: d.find_elements(by, value)
+        # Eager page loads can hand over the DOM before the elements are rendered
+        elements_found = self.__wait(
+            lambda d: (elements := d.find_elements(by, value)) and elements[0].is_displayed() and elements,
+            timeout,
+            f"Element not found: {by}={value}",
         )
-        while not elements_found and timeout > 0:
-            time.sleep(0.1)
-            timeout -= 0.1
-        if not elements_found:
-            raise RuntimeError(f"Element not found: {by}={value}")
         return [ElementActions(x) for x in elements_found]
 
     def find_element(self, by, value, timeout=10):
         return self.find_elements(by, value, timeout=timeout)[0]
 
-
-
     def wait_for_url(self, url = None, regex = None, timeout=10):
         if not self.__started:
             raise RuntimeError("Browser is not started.")
@@ -143,35 +218,37 @@ class BrowserFirefox:
             raise ValueError("Either url or regex must be provided.")
 
         if regex is None:
-            found = WebDriverWait(self.driver, timeout).until(lambda d: url in d.current_url)
+            self.__wait(lambda d: url in d.current_url, timeout, f"URL not reached: {url}")
         else:
-            found = WebDriverWait(self.driver, timeout).until(lambda d: re.search(regex, d.current_url) is not None)
-
-        while not found and timeout > 0:
-            time.sleep(0.1)
-            timeout -= 0.1
-            if regex is None:
-                found = WebDriverWait(self.driver, timeout).until(lambda d: url in d.current_url)
-            else:
-                found = WebDriverWait(self.driver, timeout).until(lambda d: re.search(regex, d.current_url) is not None)
+            self.__wait(lambda d: re.search(regex, d.current_url) is not None, timeout, f"URL not reached: {regex}")
 
     def wait_for_element(self, by, value, timeout=10):
         if not self.__started:
             raise RuntimeError("Browser is not started.")
-        elements_found = WebDriverWait(self.driver, timeout).until(
-            lambda d: d.find_elements(by, value)
-        )
-        while not elements_found and timeout > 0:
-            time.sleep(0.1)
-            timeout -= 0.1
-        if not elements_found:
-            raise RuntimeError(f"Element not found: {by}={value}")
+        self.__wait(lambda d: d.find_elements(by, value), timeout, f"Element not found: {by}={value}")
+
+    def __wait(self, condition, timeout, message):
+        """
+        Wait until the condition returns a truthy value and return it, polling at `poll_frequency`.
+        """
+        try:
+            return WebDriverWait(self.driver, timeout, poll_frequency=self.poll_frequency,
+                                 ignored_exceptions=(StaleElementReferenceException,)).until(condition)
+        except TimeoutException as e:
+            raise RuntimeError(message) from e
 
     def get_cookies(self):
         if not self.__started:
             raise RuntimeError("Browser is not started.")
         return self.driver.get_cookies()
 
+def get_default_poll_frequency() -> float:
+    """
+    Get the default poll frequency of browser waits, in seconds.
+    """
+    return __poll_frequency
+
+
 def get_2fa_options(browser: BrowserFirefox) -> list[tuple[str, ElementActions]]:
     """
     Get the available 2FA options.
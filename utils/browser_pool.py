@@ -0,0 +1,238 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from utils.browser import BrowserFirefox
+
+__pool_size = int(os.getenv("BROWSER_POOL_SIZE", "1"))
+__pool_max_uses = int(os.getenv("BROWSER_POOL_MAX_USES", "10"))
+__pool_memory_budget_mb = int(os.getenv("BROWSER_POOL_MEMORY_BUDGET_MB", "0"))
+__lean_login = os.getenv("BROWSER_LEAN_LOGIN", "true").lower() == "true"
+__browser_pool: Optional["BrowserPool"] = None
+__browser_pool_lock = threading.Lock()
+
+
+def get_process_tree_rss(pid: int) -> int | None:
+    """
+    Get the resident memory of a process and all of its descendants, in bytes.
+    Firefox renders in child processes, so the main process alone undercounts it.
+
+    :param pid: The process ID of the root process.
+    :return: The resident memory, or None if it cannot be read on this platform.
+    """
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+            for task in Path(f"/proc/{current}/task").iterdir():
+                children = (task / "children").read_text().split()
+                pending.extend(int(child) for child in children)
+    except (OSError, ValueError):
+        return None if total == 0 else total
+    return total
+
+
+class PooledBrowser:
+    """
+    A started browser owned by the pool, with the bookkeeping needed to decide when to recycle it.
+    """
+
+    def __init__(self, browser: BrowserFirefox):
+        self.browser = browser
+        self.uses = 0
+        self.started_at = time.time()
+
+    def get_memory_usage(self) -> int | None:
+        pid = self.browser.get_process_id()
+        return None if pid is None else get_process_tree_rss(pid)
+
+
+class BrowserPool:
+    """
+    Pool of pre-launched browsers for logins.
+
+    Up to `size` browsers are kept started in the background so a login does not pay for a cold start.
+    Browsers are reset between users and recycled after `max_uses` logins, when they crash, or when the
+    pool is over its memory budget. All methods are blocking and meant to be called from login threads.
+    """
+
+    def __init__(self, factory: Callable[[], BrowserFirefox], size: int, max_uses: int, memory_budget_mb: int):
+        self.__factory = factory
+        self.__size = size
+        self.__max_uses = max_uses
+        self.__memory_budget = memory_budget_mb * 1024 * 1024
+        self.__condition = threading.Condition()
+        self.__idle: list[PooledBrowser] = []
+        self.__busy: dict[BrowserFirefox, PooledBrowser] = {}
+        self.__launching = 0
+        self.__closed = False
+
+    def start(self) -> None:
+        """
+        Launch the pre-warmed browsers in the background.
+        """
+        self.__replenish_in_background()
+
+    def acquire(self, timeout: float | None = None) -> BrowserFirefox:
+        """
+        Take a started browser out of the pool, launching one if none is idle and the budget allows it.
+
+        :param timeout: The maximum time to wait for a browser when the pool is at its memory budget.
+        :return: A started, clean browser.
+        """
+        launch = False
+        with self.__condition:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                if self.__closed:
+                    raise RuntimeError("Browser pool is closed.")
+                pooled = self.__take_idle()
+                if pooled is not None:
+                    break
+                if self.__can_launch():
+                    self.__launching += 1
+                    launch = True
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No browser available within the memory budget.")
+                self.__condition.wait(remaining)
+        if launch:
+            try:
+                pooled = self.__launch()
+            finally:
+                with self.__condition:
+                    self.__launching -= 1
+        with self.__condition:
+            pooled.uses += 1
+            self.__busy[pooled.browser] = pooled
+        # Keep the next login warm while this one runs
+        self.__replenish_in_background()
+        return pooled.browser
+
+    def release(self, browser: BrowserFirefox, healthy: bool = True) -> None:
+        """
+        Give a browser back to the pool. It is reset for the next user, or stopped if it is unhealthy,
+        used up, or the pool is over its memory budget.
+
+        :param browser: The browser to give back.
+        :param healthy: False if the login using it failed and its state is unknown.
+        """
+        with self.__condition:
+            pooled = self.__busy.pop(browser, None)
+        if pooled is None:
+            browser.stop()
+            return
+        reusable = healthy and not self.__closed and pooled.uses < self.__max_uses and browser.is_alive()
+        if reusable:
+            try:
+                browser.reset()
+            except Exception as e:
+                logging.warning(f"Failed to reset pooled browser, recycling it: {e}")
+                reusable = False
+        if reusable and self.__memory_budget and self.__get_memory_usage() > self.__memory_budget:
+            logging.info("Browser pool is over its memory budget, recycling a browser")
+            reusable = False
+        if reusable:
+            with self.__condition:
+                self.__idle.append(pooled)
+                self.__condition.notify()
+            return
+        self.__stop(pooled)
+        with self.__condition:
+            self.__condition.notify()
+        self.__replenish_in_background()
+
+    def close(self) -> None:
+        """
+        Stop every idle browser. Browsers in use are stopped when they are released.
+        """
+        with self.__condition:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+            self.__condition.notify_all()
+        for pooled in idle:
+            self.__stop(pooled)
+
+    def __take_idle(self) -> PooledBrowser | None:
+        while self.__idle:
+            pooled = self.__idle.pop()
+            if pooled.browser.is_alive():
+                return pooled
+            logging.warning("Pooled browser crashed while idle, discarding it")
+            self.__stop(pooled)
+        return None
+
+    def __can_launch(self) -> bool:
+        if not self.__memory_budget:
+            return True
+        running = self.__idle + list(self.__busy.values())
+        if not running:
+            return True
+        # Assume a new browser costs as much as the average running one
+        usage = self.__get_memory_usage(running)
+        return usage + usage / len(running) <= self.__memory_budget
+
+    def __get_memory_usage(self, browsers: list[PooledBrowser] | None = None) -> int:
+        if browsers is None:
+            with self.__condition:
+                browsers = self.__idle + list(self.__busy.values())
+        return sum(pooled.get_memory_usage() or 0 for pooled in browsers)
+
+    def __launch(self) -> PooledBrowser:
+        browser = self.__factory()
+        browser.start()
+        logging.debug("Launched pooled browser")
+        return PooledBrowser(browser)
+
+    def __stop(self, pooled: PooledBrowser) -> None:
+        try:
+            pooled.browser.stop()
+        except Exception as e:
+            logging.warning(f"Failed to stop pooled browser: {e}")
+
+    def __replenish_in_background(self) -> None:
+        threading.Thread(target=self.__replenish, name="browser-pool", daemon=True).start()
+
+    def __replenish(self) -> None:
+        while True:
+            with self.__condition:
+                if self.__closed or len(self.__idle) + self.__launching >= self.__size or not self.__can_launch():
+                    return
+                self.__launching += 1
+            try:
+                pooled = self.__launch()
+            except Exception as e:
+                logging.error(f"Failed to launch pooled browser: {e}")
+                return
+            finally:
+                with self.__condition:
+                    self.__launching -= 1
+            with self.__condition:
+                if self.__closed:
+                    self.__stop(pooled)
+                    return
+                self.__idle.append(pooled)
+                self.__condition.notify()
+
+
+def get_browser_pool(headless=True) -> BrowserPool:
+    """
+    Get the browser pool shared by every login, creating it on first use.
+
+    :param headless: Run the pooled browsers headless. Only used on creation.
+    """
+    global __browser_pool
+    with __browser_pool_lock:
+        if __browser_pool is None:
+            lean = __lean_login
+            __browser_pool = BrowserPool(lambda: BrowserFirefox(headless=headless, lean=lean), __pool_size,
+                                         __pool_max_uses, __pool_memory_budget_mb)
+        return __browser_pool
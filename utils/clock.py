@@ -0,0 +1,102 @@
+import logging
+import time
+import weakref
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+
+
+class ServerClock:
+    """
+    Estimate of the server clock built from the `Date` headers and round trip times of HTTP responses.
+
+    A `Date` header only has second resolution, so every response bounds the offset between the server and
+    the local clock to `[date - received_at, date + 1 - sent_at]`. Intersecting the bounds of the most recent
+    samples narrows the offset well below a second once responses arrive at different sub-second phases.
+    """
+
+    def __init__(self, window: int = 32):
+        self.__bounds: deque[tuple[float, float]] = deque(maxlen=window)
+        self.__rtts: deque[float] = deque(maxlen=window)
+        self.__offset: Optional[float] = None
+        self.__sent_at: weakref.WeakKeyDictionary[httpx.Request, float] = weakref.WeakKeyDictionary()
+
+    def observe(self, date_header: str, sent_at: float, received_at: float) -> None:
+        """
+        Add a sample from a response.
+        :param date_header: The value of the `Date` header of the response.
+        :param sent_at: The local time the request was sent at, in epoch seconds.
+        :param received_at: The local time the response was received at, in epoch seconds.
+        """
+        try:
+            server_time = parsedate_to_datetime(date_header).timestamp()
+        except (TypeError, ValueError):
+            logging.debug(f"Ignoring invalid Date header: {date_header}")
+            return
+        self.__rtts.append(max(0.0, received_at - sent_at))
+
+        bounds = (server_time - received_at, server_time + 1 - sent_at)
+        low = max([bounds[0]] + [b[0] for b in self.__bounds])
+        high = min([bounds[1]] + [b[1] for b in self.__bounds])
+        if low > high:
+            # The bounds no longer agree, one of the clocks was stepped. Start over from this sample.
+            logging.debug("Server clock samples disagree, resetting offset estimate")
+            self.__bounds.clear()
+            low, high = bounds
+        self.__bounds.append(bounds)
+        self.__offset = (low + high) / 2
+
+    def get_offset(self) -> float:
+        """
+        Get the estimated server clock minus the local clock, in seconds. 0 until a sample was observed.
+        """
+        return self.__offset or 0.0
+
+    def get_min_rtt(self) -> float:
+        """
+        Get the lowest recent round trip time, in seconds. It is the closest to the pure network delay since
+        it includes the least server processing time.
+        """
+        return min(self.__rtts) if self.__rtts else 0.0
+
+    def now(self) -> float:
+        """
+        Get the corrected server time, in epoch seconds.
+        """
+        return time.time() + self.get_offset()
+
+    def send_time_for_arrival(self, server_time: float) -> float:
+        """
+        Get the local time a request has to be sent at to reach the server at the given server time.
+        :param server_time: The server arrival time, in epoch seconds.
+        :return: The local send time, in epoch seconds.
+        """
+        return server_time - self.get_offset() - self.get_min_rtt() / 2
+
+    def event_hooks(self) -> dict[str, list]:
+        """
+        Get the httpx event hooks that feed this clock from every request made by a client.
+        """
+        return {"request": [self.__on_request], "response": [self.__on_response]}
+
+    async def __on_request(self, request: httpx.Request) -> None:
+        self.__sent_at[request] = time.time()
+
+    async def __on_response(self, response: httpx.Response) -> None:
+        received_at = time.time()
+        sent_at = self.__sent_at.pop(response.request, None)
+        date_header = response.headers.get("Date")
+        if sent_at is not None and date_header is not None:
+            self.observe(date_header, sent_at, received_at)
+
+
+__server_clock = ServerClock()
+
+
+def get_server_clock() -> ServerClock:
+    """
+    Get the clock estimate shared by every user session talking to the AtoZ backend.
+    """
+    return __server_clock
@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import os
+from typing import Optional
+
+__global_limit = int(os.getenv("DISPATCH_GLOBAL_LIMIT", "16"))
+__per_user_limit = int(os.getenv("DISPATCH_PER_USER_LIMIT", "4"))
+__tier_stagger = float(os.getenv("DISPATCH_TIER_STAGGER", "0"))
+
+
+class PriorityDispatcher:
+    """
+    Gate for outbound requests that hands out a limited number of in-flight slots strictly by priority.
+
+    Waiters are kept in a heap ordered by priority, highest first, then by arrival. A waiter whose user already
+    holds its per-user limit is passed over without blocking the others. With a tier stagger, a priority only
+    starts once the stagger has passed since the last slot given to any higher priority that still has requests
+    waiting or in flight, so under load each tier gets the first outbound slots ahead of the next one while an
+    idle higher tier holds nobody back.
+    """
+
+    def __init__(self, global_limit: int, per_user_limit: int, tier_stagger: float = 0):
+        self.__global_limit = global_limit
+        self.__per_user_limit = per_user_limit
+        self.__tier_stagger = tier_stagger
+        self.__in_flight = 0
+        self.__in_flight_by_key: dict[str, int] = {}
+        self.__in_flight_by_priority: dict[int, int] = {}
+        self.__waiters: list[tuple[int, int, str, asyncio.Future]] = []
+        self.__counter = itertools.count()
+        # Loop time of the last slot given to each priority
+        self.__last_grant: dict[int, float] = {}
+        self.__timer: Optional[asyncio.TimerHandle] = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key: str, priority: int):
+        """
+        Hold an in-flight slot for the duration of the block.
+        :param key: The user the request is sent for.
+        :param priority: The priority of the user, higher goes first.
+        """
+        await self.acquire(key, priority)
+        try:
+            yield
+        finally:
+            self.release(key, priority)
+
+    async def acquire(self, key: str, priority: int) -> None:
+        """
+        Wait for an in-flight slot. Every acquire must be paired with a `release`.
+        :param key: The user the request is sent for.
+        :param priority: The priority of the user, higher goes first.
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.__waiters, (-priority, next(self.__counter), key, future))
+        self.__dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled waiters are dropped from the heap lazily, a slot granted in the meantime is given back
+            if future.done() and not future.cancelled():
+                self.release(key, priority)
+            raise
+
+    def release(self, key: str, priority: int) -> None:
+        """
+        Give back an in-flight slot.
+        :param key: The user the request was sent for.
+        :param priority: The priority the slot was acquired with.
+        """
+        self.__in_flight -= 1
+        self.__decrement(self.__in_flight_by_key, key)
+        self.__decrement(self.__in_flight_by_priority, priority)
+        self.__dispatch()
+
+    @staticmethod
+    def __decrement(counts: dict, key) -> None:
+        remaining = counts.get(key, 1) - 1
+        if remaining > 0:
+            counts[key] = remaining
+        else:
+            counts.pop(key, None)
+
+    def __ready_at(self, priority: int, busy: set[int]) -> float:
+        if not self.__tier_stagger:
+            return 0.0
+        # A higher priority with nothing waiting or in flight does not hold lower ones back
+        return max((granted_at + self.__tier_stagger for tier, granted_at in self.__last_grant.items()
+                    if tier > priority and tier in busy), default=0.0)
+
+    def __dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        passed_over = []
+        wake_at = None
+        busy = set(self.__in_flight_by_priority)
+        if self.__tier_stagger:
+            busy.update(-negative_priority for negative_priority, _, _, future in self.__waiters if not future.done())
+        while self.__waiters and self.__in_flight < self.__global_limit:
+            entry = heapq.heappop(self.__waiters)
+            negative_priority, _, key, future = entry
+            if future.done():
+                continue
+            if self.__in_flight_by_key.get(key, 0) >= self.__per_user_limit:
+                passed_over.append(entry)
+                continue
+            priority = -negative_priority
+            ready_at = self.__ready_at(priority, busy)
+            if ready_at > now:
+                # Lower priorities are held back at least as long, stop here
+                passed_over.append(entry)
+                wake_at = ready_at
+                break
+            self.__in_flight += 1
+            self.__in_flight_by_key[key] = self.__in_flight_by_key.get(key, 0) + 1
+            self.__in_flight_by_priority[priority] = self.__in_flight_by_priority.get(priority, 0) + 1
+            self.__last_grant[priority] = now
+            future.set_result(None)
+        for entry in passed_over:
+            heapq.heappush(self.__waiters, entry)
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if wake_at is not None:
+            self.__timer = loop.call_at(wake_at, self.__fire)
+
+    def __fire(self) -> None:
+        self.__timer = None
+        self.__dispatch()
+
+
+__dispatcher: Optional[PriorityDispatcher] = None
+
+
+def get_dispatcher() -> PriorityDispatcher:
+    """
+    Get the dispatcher shared by the discovery and pick requests of every user, creating it on first use.
+    """
+    global __dispatcher
+    if __dispatcher is None:
+        __dispatcher = PriorityDispatcher(__global_limit, __per_user_limit, __tier_stagger)
+    return __dispatcher
@@ -0,0 +1,109 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Optional
+
+
+class DeadlineScheduler:
+    """
+    Sleep coordinator backed by a single heap of next-due deadlines.
+
+    Every waiter registers the wall-clock time it wants to be woken at. One loop timer is armed for the
+    earliest deadline in the heap, so idle waiters cost nothing and each one wakes exactly when it is due.
+    Deadlines are epoch seconds, the same scale as `time.time()` and `datetime.timestamp()`.
+    """
+
+    def __init__(self):
+        self.__heap: list[tuple[float, int, str]] = []
+        self.__waiters: dict[str, tuple[int, asyncio.Future]] = {}
+        self.__counter = itertools.count()
+        self.__timer: Optional[asyncio.TimerHandle] = None
+        self.__timer_deadline: Optional[float] = None
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def sleep_until(self, key: str, deadline: float) -> bool:
+        """
+        Sleep until the given deadline or until the key is woken.
+        :param key: The key identifying the waiter. A new wait for the same key replaces the previous one.
+        :param deadline: The wall-clock time to wake at, in epoch seconds.
+        :return: True if the deadline was reached, False if the waiter was woken early.
+        """
+        self.__loop = asyncio.get_running_loop()
+        self.__discard(key)
+        if deadline <= time.time():
+            return True
+        sequence = next(self.__counter)
+        future = self.__loop.create_future()
+        self.__waiters[key] = (sequence, future)
+        heapq.heappush(self.__heap, (deadline, sequence, key))
+        self.__arm()
+        try:
+            return await future
+        finally:
+            if self.__waiters.get(key, (None,))[0] == sequence:
+                del self.__waiters[key]
+
+    def wake(self, key: str) -> None:
+        """
+        Wake the waiter for the given key immediately. Safe to call from any thread.
+        :param key: The key identifying the waiter.
+        """
+        if self.__loop is None or self.__loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.__loop:
+            self.__resolve(key, False)
+        else:
+            self.__loop.call_soon_threadsafe(self.__resolve, key, False)
+
+    def __discard(self, key: str) -> None:
+        # Heap entries are removed lazily, dropping the waiter is enough to invalidate them
+        entry = self.__waiters.pop(key, None)
+        if entry is not None and not entry[1].done():
+            entry[1].cancel()
+
+    def __resolve(self, key: str, result: bool) -> None:
+        entry = self.__waiters.pop(key, None)
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(result)
+
+    def __prune(self) -> None:
+        while self.__heap:
+            _, sequence, key = self.__heap[0]
+            if self.__waiters.get(key, (None,))[0] == sequence:
+                return
+            heapq.heappop(self.__heap)
+
+    def __arm(self) -> None:
+        self.__prune()
+        if not self.__heap:
+            self.__cancel_timer()
+            return
+        deadline = self.__heap[0][0]
+        if self.__timer is not None and self.__timer_deadline == deadline:
+            return
+        self.__cancel_timer()
+        delay = max(0.0, deadline - time.time())
+        self.__timer = self.__loop.call_at(self.__loop.time() + delay, self.__fire)
+        self.__timer_deadline = deadline
+
+    def __cancel_timer(self) -> None:
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__timer = None
+        self.__timer_deadline = None
+
+    def __fire(self) -> None:
+        self.__timer = None
+        self.__timer_deadline = None
+        now = time.time()
+        while self.__heap and self.__heap[0][0] <= now:
+            _, sequence, key = heapq.heappop(self.__heap)
+            if self.__waiters.get(key, (None,))[0] == sequence:
+                self.__resolve(key, True)
+        # The loop clock and the wall clock can disagree slightly, re-arm for anything left
+        self.__arm()
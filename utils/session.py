@@ -1,11 +1,69 @@
+import asyncio
+import functools
 import http.cookies
+import importlib.util
 import logging
+import os
+import weakref
+from enum import Enum
 from http.cookiejar import CookieJar, Cookie
 
 import httpx
 import requests
 from requests.cookies import RequestsCookieJar, create_cookie
 
+from utils.clock import get_server_clock
+
+GRAPHQL_HOST = "https://atoz-api-us-east-1.amazon.work"
+LOGIN_HOST = "https://atoz-login.amazon.work"
+PAGE_HOST = "https://atoz.amazon.work"
+
+__http2 = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+__limits = httpx.Limits(
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "20")),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10")),
+    keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "120")),
+)
+
+
+__transports: weakref.WeakKeyDictionary[httpx.AsyncClient, "TrackingTransport"] = weakref.WeakKeyDictionary()
+
+
+class EndpointClass(Enum):
+    GRAPHQL = "GRAPHQL"
+    LOGIN = "LOGIN"
+    PAGE = "PAGE"
+
+
+__timeouts = {
+    EndpointClass.GRAPHQL: httpx.Timeout(float(os.getenv("HTTP_TIMEOUT_GRAPHQL", "5")), connect=3.0),
+    EndpointClass.LOGIN: httpx.Timeout(float(os.getenv("HTTP_TIMEOUT_LOGIN", "15")), connect=5.0),
+    EndpointClass.PAGE: httpx.Timeout(float(os.getenv("HTTP_TIMEOUT_PAGE", "20")), connect=5.0),
+}
+
+
+def get_timeout(endpoint: EndpointClass) -> httpx.Timeout:
+    """
+    Get the timeout for requests to the given class of endpoint.
+
+    :param endpoint: The class of endpoint.
+    :return: The timeout to pass to the request.
+    """
+    return __timeouts[endpoint]
+
+
+@functools.cache
+def __is_http2_available() -> bool:
+    """
+    Check if HTTP/2 is enabled and the optional `h2` package is installed.
+    """
+    if not __http2:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        logging.warning("HTTP/2 is enabled but the h2 package is not installed, falling back to HTTP/1.1")
+        return False
+    return True
+
 
 def create_session(selenium_cookie_list: list[dict]) -> requests.Session:
     """
@@ -25,9 +83,11 @@ def create_session(selenium_cookie_list: list[dict]) -> requests.Session:
         session.cookies.set_cookie(create_cookie(**fixed_cookie))
     return session
 
-def create_httpx_async_client(selenium_cookie_list: list[dict]) -> httpx.AsyncClient:
+def create_httpx_async_client(selenium_cookie_list: list[dict] | None = None) -> httpx.AsyncClient:
     """
     Create an httpx async client with the given cookies.
+    The client negotiates HTTP/2 when available, uses the configured pool limits and
+    feeds every response into the shared server clock estimate.
 
     :param selenium_cookie_list : list[dict]
             - A list of dictionaries, each representing a cookie;
@@ -35,8 +95,151 @@ def create_httpx_async_client(selenium_cookie_list: list[dict]) -> httpx.AsyncCl
             - Optional keys - "path", "domain", "secure", "httpOnly", "expiry", "sameSite"
     :return: An httpx async client with the cookies set.
     """
-    cookie_jar = selenium_cookies_to_cookiejar(selenium_cookie_list)
-    return httpx.AsyncClient(cookies=cookie_jar)
+    cookie_jar = selenium_cookies_to_cookiejar(selenium_cookie_list or [])
+    transport = TrackingTransport(httpx.AsyncHTTPTransport(http2=__is_http2_available(), limits=__limits))
+    client = httpx.AsyncClient(
+        cookies=cookie_jar,
+        transport=transport,
+        timeout=get_timeout(EndpointClass.PAGE),
+        event_hooks=get_server_clock().event_hooks(),
+    )
+    __transports[client] = transport
+    return client
+
+
+def get_tracking_transport(client: httpx.AsyncClient) -> "TrackingTransport | None":
+    """
+    Get the tracking transport of a client created by `create_httpx_async_client`.
+
+    :param client: The client to get the transport for.
+    :return: The transport, or None if the client was created elsewhere.
+    """
+    return __transports.get(client)
+
+
+async def close_client(client: httpx.AsyncClient, drain_timeout: float) -> None:
+    """
+    Wait for the in-flight requests of a client to finish, then close it and its connection pool.
+
+    :param client: The client to close.
+    :param drain_timeout: The maximum time to wait for in-flight requests, in seconds.
+    """
+    transport = get_tracking_transport(client)
+    if transport is not None and not await transport.wait_idle(drain_timeout):
+        logging.warning(f"Closing client with {transport.get_in_flight()} requests still in flight")
+    await client.aclose()
+
+
+class TrackedByteStream(httpx.AsyncByteStream):
+    """
+    Response stream that notifies its transport once the response has been closed.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: callable):
+        self.__stream = stream
+        self.__on_close = on_close
+        self.__closed = False
+
+    async def __aiter__(self):
+        async for chunk in self.__stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if self.__closed:
+            return
+        self.__closed = True
+        try:
+            await self.__stream.aclose()
+        finally:
+            self.__on_close()
+
+
+class TrackingTransport(httpx.AsyncBaseTransport):
+    """
+    Transport wrapper that counts in-flight requests and exposes the size of the connection pool.
+    """
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport):
+        self.__transport = transport
+        self.__in_flight = 0
+        self.__idle = asyncio.Event()
+        self.__idle.set()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.__acquire()
+        try:
+            response = await self.__transport.handle_async_request(request)
+        except BaseException:
+            self.__release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=TrackedByteStream(response.stream, self.__release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self.__transport.aclose()
+
+    def get_in_flight(self) -> int:
+        """
+        Get the number of requests whose response has not been closed yet.
+        """
+        return self.__in_flight
+
+    def get_open_connections(self) -> int:
+        """
+        Get the number of connections held by the pool, idle or in use.
+        """
+        # httpx does not expose its httpcore pool, fall back to 0 if its layout ever changes
+        pool = getattr(self.__transport, "_pool", None)
+        return len(getattr(pool, "connections", []))
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """
+        Wait until no request is in flight.
+
+        :param timeout: The maximum time to wait, in seconds.
+        :return: True if the transport is idle, False if the timeout passed first.
+        """
+        try:
+            await asyncio.wait_for(self.__idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def __acquire(self) -> None:
+        self.__in_flight += 1
+        self.__idle.clear()
+
+    def __release(self) -> None:
+        self.__in_flight -= 1
+        if self.__in_flight == 0:
+            self.__idle.set()
+
+
+async def warm_connections(client: httpx.AsyncClient, hosts: tuple[str, ...] = (GRAPHQL_HOST, LOGIN_HOST),
+                           timeout: float | None = None) -> None:
+    """
+    Open a connection to each of the given hosts so later requests reuse it instead of paying
+    the TCP and TLS handshakes. Connections stay in the pool for the keep-alive expiry.
+
+    :param client: The client whose pool should be warmed.
+    :param hosts: The origins to connect to.
+    :param timeout: The time in seconds to give up warming after, None to only bound each request.
+    """
+    async def warm(host: str):
+        try:
+            await client.head(host, timeout=get_timeout(EndpointClass.LOGIN))
+        except httpx.HTTPError as e:
+            logging.debug(f"Failed to warm connection to {host}: {e}")
+
+    try:
+        async with asyncio.timeout(timeout):
+            await asyncio.gather(*(warm(host) for host in hosts))
+    except TimeoutError:
+        logging.debug(f"Gave up warming connections after {timeout:.3f}s")
 
 
 def selenium_cookies_to_cookiejar(selenium_cookies):
@@ -63,3 +266,26 @@ def selenium_cookies_to_cookiejar(selenium_cookies):
         )
         jar.set_cookie(cookie)
     return jar
+
+
+def cookiejar_to_selenium_cookies(jar: CookieJar) -> list[dict]:
+    """
+    Convert a cookie jar to a list of cookies in the Selenium format,
+    the inverse of `selenium_cookies_to_cookiejar`.
+
+    :param jar: The cookie jar to convert.
+    :return: A list of dictionaries, each representing a cookie.
+    """
+    cookies = []
+    for c in jar:
+        cookie = {
+            "name": c.name,
+            "value": c.value,
+            "domain": c.domain,
+            "path": c.path,
+            "secure": c.secure,
+        }
+        if c.expires is not None:
+            cookie["expiry"] = c.expires
+        cookies.append(cookie)
+    return cookies
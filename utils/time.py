@@ -1,6 +1,10 @@
+import heapq
+from bisect import bisect_right
 from datetime import datetime, timezone, timedelta
 import parsedatetime
 
+from utils.clock import get_server_clock
+
 
 def parse_str_to_time(string: str, timezone = timezone.utc) -> datetime:
     """
@@ -36,45 +40,90 @@ def parse_str_to_timedelta(string: str) -> timedelta:
         else:
             raise ValueError(f"Invalid time format: {string}")
 
-def split_time_block(start: datetime, end: datetime, offset: int) -> list[tuple[datetime, datetime]]:
+
+class IntervalIndex:
     """
-    Split a time block into smaller blocks.
+    Sorted, merged set of time blocks answering containment queries in O(log n).
 
-    :param start: The start time of the block.
-    :param end: The end time of the block.
-    :param offset: The offset to split the block by (in minutes).
-    :return: A list of tuples containing the start and end time of each block.
+    Blocks are stored as epoch seconds. Overlapping and touching blocks are merged, so a time block that
+    spans two adjacent blocks is contained as well.
     """
-    # Assert that start is less than end
-    if start > end:
-        raise ValueError("Start time must be less than end time.")
-    # Return start and end time if the block is less than the offset
-    if (end - start) < timedelta(days=offset):
-        return [(start, end)]
-    blocks = []
-    cursor = start
-    while cursor < end:
-        block_end_time = cursor + timedelta(days=offset)
-        if block_end_time > end:
-            block_end_time = end
-        blocks.append((cursor, block_end_time))
-        cursor = block_end_time
-    return blocks
-
-def time_block_in_blocks(
-    time_block: tuple[datetime, datetime], blocks: list[tuple[datetime, datetime]]
-) -> bool:
+
+    def __init__(self, blocks: list[tuple[datetime, datetime]]):
+        starts: list[float] = []
+        ends: list[float] = []
+        for start, end in sorted((block[0].timestamp(), block[1].timestamp()) for block in blocks):
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.__starts = starts
+        self.__ends = ends
+
+    def __len__(self) -> int:
+        return len(self.__starts)
+
+    def contains_timestamps(self, start: float, end: float) -> bool:
+        """
+        Check if a time block given in epoch seconds is within the indexed blocks.
+
+        :param start: The start of the time block.
+        :param end: The end of the time block.
+        :return: True if the time block is within the blocks, False otherwise.
+        """
+        # The only candidate is the last block starting at or before the start
+        i = bisect_right(self.__starts, start) - 1
+        return i >= 0 and end <= self.__ends[i]
+
+    def get_intervals(self) -> list[tuple[float, float]]:
+        """
+        Get the merged blocks in order, in epoch seconds.
+        """
+        return list(zip(self.__starts, self.__ends))
+
+
+def plan_windows(intervals: list[tuple[float, float]], now: float, max_window: float, min_window: float,
+                 parallelism: int, merge_gap: float = 0) -> list[tuple[float, float]]:
     """
-    Check if a time block is within the given blocks.
+    Plan the smallest set of query windows covering the given intervals from now on.
 
-    :param time_block: The time block to check.
-    :param blocks: The list of blocks to check against.
-    :return: True if the time block is within the blocks, False otherwise.
+    Past parts of the intervals are dropped, neighbours closer than the merge gap share a window, and windows
+    are split so none is longer than the max window. Short lists are then split further, longest first, until
+    there are enough windows to query in parallel or they reach the min window.
+
+    :param intervals: The sorted, disjoint intervals to cover, in epoch seconds.
+    :param now: The current time in epoch seconds.
+    :param max_window: The maximum length of a window, in seconds.
+    :param min_window: The length a window is not split below to gain parallelism, in seconds.
+    :param parallelism: The number of windows worth querying in parallel.
+    :param merge_gap: The largest gap between two intervals that is queried as part of one window, in seconds.
+    :return: The windows in order, in epoch seconds.
     """
-    for block in blocks:
-        if time_block[0] >= block[0] and time_block[1] <= block[1]:
-            return True
-    return False
+    merged: list[list[float]] = []
+    for start, end in intervals:
+        if end <= now:
+            continue
+        start = max(start, now)
+        if merged and start - merged[-1][1] <= merge_gap and end - merged[-1][0] <= max_window:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    windows = []
+    for start, end in merged:
+        cursor = start
+        while cursor < end:
+            windows.append((cursor, min(cursor + max_window, end)))
+            cursor += max_window
+    # Split the longest windows in half while the queries would not use the available parallelism
+    heap = [(start - end, start, end) for start, end in windows]
+    heapq.heapify(heap)
+    while heap and len(heap) < parallelism and -heap[0][0] >= 2 * min_window:
+        _, start, end = heapq.heappop(heap)
+        middle = start + (end - start) / 2
+        heapq.heappush(heap, (start - middle, start, middle))
+        heapq.heappush(heap, (middle - end, middle, end))
+    return sorted((start, end) for _, start, end in heap)
 
 from zoneinfo import ZoneInfo
 
@@ -107,11 +156,11 @@ def parse_str_to_time_zone(tz_str: str) -> ZoneInfo:
 
 def is_time(t: datetime, error_margin: timedelta = timedelta(minutes=5)) -> bool:
     """
-    Check if the given time is within the error margin of the current time.
+    Check if the given time is within the error margin of the current server time.
 
     :param t: The time to check.
     :param error_margin: The error margin to use.
     :return: True if the time is within the error margin, False otherwise.
     """
-    now = datetime.now(tz=timezone.utc)
+    now = datetime.fromtimestamp(get_server_clock().now(), tz=timezone.utc)
     return now - error_margin <= t <= now + error_margin
\ No newline at end of file
@@ -10,7 +10,7 @@ from watchdog.events import FileSystemEventHandler, FileSystemEvent, FileCreated
     FileDeletedEvent
 from watchdog.observers import Observer
 
-from app.models import UserConfig, TwoFAMethod
+from app.models import UserConfig, TwoFAMethod, SkillType, PickValue
 from utils.time import parse_str_to_time, parse_str_to_time_zone, parse_str_to_timedelta
 
 
@@ -61,12 +61,8 @@ class Watcher(FileSystemEventHandler):
                 if not event.src_path.endswith(".toml"):
                     return
                 logging.debug("Config file deleted: %s", event.src_path)
-                # parse the toml into a user config
-                data = load_config(Path(event.src_path))
-                if data is None:
-                    logging.error("Error parsing config file: %s", event.src_path)
-                    return
-                self.__on_delete(data, event.src_path)
+                # The file is already gone, so the session has to be resolved from its path
+                self.__on_delete(None, event.src_path)
 
     def start(self):
         self.__observer.schedule(self, self.__path, recursive=True)
@@ -88,7 +84,9 @@ def load_config(path: Path) -> UserConfig | None:
             config = Config(type_hooks={tuple[TwoFAMethod, str]: lambda v: (TwoFAMethod(v[0]), v[1]),
                                         datetime.datetime: parse_str_to_time,
                                         datetime.timedelta: parse_str_to_timedelta,
-                                        ZoneInfo: parse_str_to_time_zone})
+                                        ZoneInfo: parse_str_to_time_zone,
+                                        SkillType: SkillType,
+                                        PickValue: PickValue})
             data = from_dict(
                 data_class=UserConfig,
                 data=tomli.load(f),